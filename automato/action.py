@@ -1,12 +1,47 @@
 from typing import Dict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import asyncio
 import logging
+import threading
 import time
 
 from . import endpoint
 from . import trigger
+from . import metrics
 
 logger = logging.getLogger(__name__)
 
+# Pool running the commands of all actions, see Action._runParallel()
+DISPATCH_WORKERS = 32
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def _dispatch_pool() -> ThreadPoolExecutor:
+    global _dispatcher
+
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = ThreadPoolExecutor(max_workers=DISPATCH_WORKERS, thread_name_prefix='automato-dispatch')
+
+    return _dispatcher
+
+'''
+Action
+
+The commands in `then` are compiled into a plan of chains when the action is
+built. Chains run concurrently, the commands of a chain one after another:
+  parallel: Run the commands of different endpoints concurrently (default True).
+            Otherwise all commands form a single chain, in configured order.
+  ordered:  Keep the configured order of the commands of the same endpoint
+            (default True). Otherwise every command is its own chain.
+  timeout:  Seconds to wait for every single command (default: no timeout),
+            counted from when it starts running.
+
+If a command fails or times out, the rest of its chain is skipped.
+The result of every command (ok, failed, timeout, skipped) is counted in
+metrics and the results of the last run are kept in lastResults().
+A timed out command is no longer waited for, but can not be interrupted.
+'''
 class Action:
     # TODO: Cooldown, wait fot state change, repeat, etc?
     def __init__(
@@ -22,12 +57,17 @@ class Action:
 
         self._repeat = config['repeat'] if 'repeat' in config else True
         self._cooldown = config['cooldown'] if 'cooldown' in config else 0
+        self._parallel = config['parallel'] if 'parallel' in config else True
+        self._ordered = config['ordered'] if 'ordered' in config else True
+        self._timeout = config['timeout'] if 'timeout' in config else None
         self._last_run = 0
         self._last_state = False
+        self._results = []
 
         self._configured_trigger_keys = []
 
         self._setup_triggers()
+        self._compilePlan()
 
     def _setup_triggers(self):
         for trg_list_item in self._trigger_cfg:
@@ -47,35 +87,190 @@ class Action:
             logger.debug(f'Action "{self._name}" was registered with "{trg_key}"')
 
 
-    def execute(self):
-        if not all([self._triggers[b].evaluate(self._name) for b in self._configured_trigger_keys]):
+    def dumpSnapshot(self) -> dict:
+        return {'last_run': self._last_run, 'last_state': self._last_state}
+
+    def loadSnapshot(self, snapshot: dict):
+        self._last_run = snapshot['last_run']
+        self._last_state = snapshot['last_state']
+
+    # Time at which the first trigger is due, None without triggers
+    def nextRun(self) -> [None,float]:
+        if not self._configured_trigger_keys:
+            return None
+
+        return min([self._triggers[b].nextEvaluation(self._name) for b in self._configured_trigger_keys])
+
+    def _shouldRun(self, results: list) -> bool:
+        if not all(results):
             self._last_state = False
             logger.debug(f'Action "{self._name}" will not execute. Conditions not met.')
-            return
+            return False
 
         if self._last_state and not self._repeat:
             logger.debug(f'Action "{self._name}": Conditions are met but won\'t repeat')
-            return
+            return False
 
         if time.time() - self._last_run <= self._cooldown:
             logger.debug(f'Action "{self._name}": Conditions are met but cooldown time not reached')
-            return
+            return False
 
         self._last_run = time.time()
         self._last_state = True
 
         logger.info(f'Executing Action "{self._name}". Conditions are met.')
+        return True
 
-        for then_item in self._then_cfg:
+    # Validates then and groups it into chains of (index, endpoint, command, arguments)
+    def _compilePlan(self):
+        self._then = []
+        for index, then_item in enumerate(self._then_cfg):
             if len(then_item.keys()) != 1:
-                logger.error(f'Action "{self._name}" encountered error while executing command "{then_item}"')
+                logger.error(f'Action "{self._name}" encountered error while adding command "{then_item}"')
                 raise Exception
 
             cmd_key = list(then_item.keys())[0]
-            cmd_config = then_item[cmd_key]
+            endpoint, _, command = cmd_key.partition('.')
+            if not command or endpoint not in self._endpoints or not self._endpoints[endpoint].hasCommand(command):
+                logger.error(f'Action "{self._name}": Command "{cmd_key}" is not configured.')
+                raise Exception
+
+            self._then.append((index, endpoint, command, then_item[cmd_key] or {}))
+
+        if not self._parallel:
+            self._plan = [self._then] if self._then else []
+        elif not self._ordered:
+            self._plan = [[item] for item in self._then]
+        else:
+            chains = {}
+            for item in self._then:
+                chains.setdefault(item[1], []).append(item)
+            self._plan = list(chains.values())
+
+    # Result of every command in then of the last run
+    def lastResults(self) -> list:
+        return [(f'{endpoint}.{command}', self._results[index]) for index, endpoint, command, _ in self._then] if self._results else []
+
+    def _report(self, results: list):
+        self._results = results
+
+        for index, endpoint, command, _ in self._then:
+            metrics.COMMAND_RESULT.inc(endpoint=endpoint, command=command, result=results[index])
+
+        failed = [f'{e}.{c}: {results[i]}' for i, e, c, _ in self._then if results[i] != 'ok']
+        if failed:
+            logger.warning(f'Action "{self._name}": {len(failed)} of {len(results)} commands did not succeed: {failed}')
+
+    def _runCommand(self, item: tuple):
+        _, endpoint, command, cmd_config = item
+        logger.info(f'Executing command "{endpoint}.{command}"')
+        self._endpoints[endpoint].executeCommand(command, **cmd_config)
 
-            logger.info(f'Executing command "{cmd_key}"')
-            endpoint, command = cmd_key.split('.', 1)
-            self._endpoints[endpoint].executeCommand(command, **cmd_config)
+    # Runs a single chain without timeout in the calling thread
+    def _runInline(self, chain: list, results: list):
+        for item in chain:
+            try:
+                self._runCommand(item)
+            except Exception as e:
+                logger.error(f'Action "{self._name}": Command "{item[1]}.{item[2]}" failed: {e}')
+                results[item[0]] = 'failed'
+                return
 
+            results[item[0]] = 'ok'
+
+    # Runs all chains on the dispatch pool. Only the calling thread submits
+    # commands, the next one of a chain as soon as the previous one finished.
+    def _runParallel(self, results: list):
+        pool = _dispatch_pool()
+        running = {}
+
+        # The timeout starts when a worker runs the command, not while it is queued
+        def run(item: tuple, started: list):
+            started.append(time.monotonic())
+            self._runCommand(item)
+
+        def submit(chain: list, position: int):
+            started = []
+            running[pool.submit(run, chain[position], started)] = (chain, position, started)
+
+        for chain in self._plan:
+            submit(chain, 0)
+
+        while running:
+            timeout = None
+            if self._timeout is not None:
+                # Queued commands have at least the full timeout left
+                now = time.monotonic()
+                timeout = max(0, min([s[0] if s else now for _, _, s in running.values()]) + self._timeout - now)
+            wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            now = time.monotonic()
+            for f in list(running):
+                chain, position, started = running[f]
+                index, endpoint, command, _ = chain[position]
+
+                if f.done():
+                    del running[f]
+                    if f.exception() is not None:
+                        logger.error(f'Action "{self._name}": Command "{endpoint}.{command}" failed: {f.exception()}')
+                        results[index] = 'failed'
+                        continue
+
+                    results[index] = 'ok'
+                    if position + 1 < len(chain):
+                        submit(chain, position + 1)
+                elif self._timeout is not None and started and now >= started[0] + self._timeout:
+                    del running[f]
+                    logger.error(f'Action "{self._name}": Command "{endpoint}.{command}" timed out after {self._timeout}s')
+                    results[index] = 'timeout'
+
+    def _dispatch(self):
+        results = ['skipped'] * len(self._then)
+
+        if len(self._plan) == 1 and self._timeout is None:
+            self._runInline(self._plan[0], results)
+        elif self._plan:
+            self._runParallel(results)
+
+        self._report(results)
+
+    async def _arunChain(self, chain: list, results: list):
+        for index, endpoint, command, cmd_config in chain:
+            logger.info(f'Executing command "{endpoint}.{command}"')
+            try:
+                await asyncio.wait_for(self._endpoints[endpoint].aexecuteCommand(command, **cmd_config), self._timeout)
+            except asyncio.TimeoutError:
+                logger.error(f'Action "{self._name}": Command "{endpoint}.{command}" timed out after {self._timeout}s')
+                results[index] = 'timeout'
+                return
+            except Exception as e:
+                logger.error(f'Action "{self._name}": Command "{endpoint}.{command}" failed: {e}')
+                results[index] = 'failed'
+                return
+
+            results[index] = 'ok'
+
+    async def _adispatch(self):
+        results = ['skipped'] * len(self._then)
+        await asyncio.gather(*[self._arunChain(chain, results) for chain in self._plan])
+        self._report(results)
+
+    def execute(self):
+        with metrics.ACTION_EXECUTE.time(action=self._name):
+            self._execute()
+
+    async def aexecute(self):
+        with metrics.ACTION_EXECUTE.time(action=self._name):
+            await self._aexecute()
+
+    def _execute(self):
+        if not self._shouldRun([self._triggers[b].evaluate(self._name) for b in self._configured_trigger_keys]):
+            return
+
+        self._dispatch()
+
+    async def _aexecute(self):
+        if not self._shouldRun([await self._triggers[b].aevaluate(self._name) for b in self._configured_trigger_keys]):
+            return
 
+        await self._adispatch()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import select
+import socket
+import time
+
+from automato import config, misc
+from automato.transport import push
+from automato.transport.local import LocalTransport
+
+logger = logging.getLogger(__name__)
+
+'''
+automato agent
+
+Runs on an endpoint, collects its states locally and pushes their changes
+to a PushTransport of the central automato process over a single
+connection, see automato.transport.push. It is configured in agent.yml:
+
+```yaml
+agent: host1
+central: automato.example.com
+port: 7755
+token: secret
+states:
+  load:
+    class: automato.state.LinuxLoadState
+    ttl: 10
+```
+
+States are the usual State classes and get a LocalTransport as transport.
+They are checked every `interval` seconds and collected when their ttl
+expired. Only changed keys are pushed, all states are pushed in full after
+(re)connecting.
+'''
+class Agent:
+    def __init__(self, cfg: dict):
+        self._name = cfg['agent']
+        self._central = cfg['central']
+        self._port = cfg.get('port', push.DEFAULT_PORT)
+        self._token = cfg.get('token')
+        self._timeout = cfg.get('timeout', 10)
+
+        self._backoff = cfg.get('backoff', 1)
+        self._max_backoff = cfg.get('max_backoff', 300)
+        self._next_backoff = self._backoff
+        self._next_attempt = 0
+
+        self._transport = LocalTransport(cfg.get('info', {}), **cfg.get('transport', {}))
+        self._transport.connect()
+        self._states = {}
+        for key, state_cfg in cfg.get('states', {}).items():
+            state_cfg = dict(state_cfg)
+            cls = misc.import_class(state_cfg.pop('class'))
+            state_cfg.setdefault('transport', self._transport)
+
+            self._states[key] = cls(cfg.get('info', {}), **state_cfg)
+            self._states[key].setName(self._name, key)
+
+        # Data of the states as last pushed
+        self._sent = {}
+        self._sock = None
+
+    # The central process never sends anything, so a readable socket was closed
+    def _alive(self) -> bool:
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        return not readable
+
+    def _connect(self) -> bool:
+        if self._sock is not None:
+            if self._alive():
+                return True
+
+            logger.error(f'Lost connection to {self._central}:{self._port}')
+            self._disconnect()
+
+        if time.time() < self._next_attempt:
+            return False
+
+        try:
+            sock = socket.create_connection((self._central, self._port), timeout=self._timeout)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.sendall(push.encode({'agent': self._name, 'token': self._token}))
+        except OSError as e:
+            logger.error(f'Failed to connect to {self._central}:{self._port}: {e}')
+            logger.debug(f'Next connection attempt in {self._next_backoff}s')
+            self._next_attempt = time.time() + self._next_backoff
+            self._next_backoff = min(2 * self._next_backoff, self._max_backoff)
+            return False
+
+        logger.info(f'Connected to {self._central}:{self._port}')
+        self._sock = sock
+        self._sent = {}
+        self._next_backoff = self._backoff
+        return True
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+
+        self._sock = None
+
+    def close(self):
+        self._disconnect()
+        self._transport.disconnect()
+
+    # returns the message pushing the changes of state key, or None
+    def _delta(self, key: str, data: dict) -> [None,dict]:
+        if key not in self._sent:
+            return {'state': key, 'set': data, 'full': True}
+
+        old = self._sent[key]
+        changed = {k: v for k, v in data.items() if k not in old or old[k] != v}
+        removed = [k for k in old if k not in data]
+        if not changed and not removed:
+            return None
+
+        message = {'state': key}
+        if changed:
+            message['set'] = changed
+        if removed:
+            message['unset'] = removed
+
+        return message
+
+    def run(self):
+        for key, stt in self._states.items():
+            try:
+                stt.refresh()
+            except Exception as e:
+                logger.error(f'Failed to collect state "{key}": {e}')
+
+        if not self._connect():
+            return
+
+        current = {key: self._states[key].toDict() for key in self._states}
+        messages = {}
+        for key in current:
+            message = self._delta(key, current[key])
+            if message is not None:
+                messages[key] = message
+
+        if not messages:
+            return
+
+        try:
+            self._sock.sendall(b''.join([push.encode(m) for m in messages.values()]))
+        except OSError as e:
+            logger.error(f'Lost connection to {self._central}:{self._port}: {e}')
+            self._disconnect()
+            return
+
+        logger.debug(f'Pushed {len(messages)} states')
+        for key in messages:
+            self._sent[key] = current[key]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='automato agent')
+    parser.add_argument('-c', '--config', default='agent.yml',
+                        help='configuration file')
+    parser.add_argument('-i', '--interval', type=float, default=1,
+                        help='time in seconds between two checks of the states')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log debug messages')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s | %(levelname)s | %(name)s - %(message)s',
+                        datefmt='%c')
+
+    agent = Agent(config.load_yaml(args.config))
+
+    try:
+        while True:
+            starttime = time.time()
+            agent.run()
+            time.sleep(max(0, starttime + args.interval - time.time()))
+    finally:
+        agent.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+Helpers for the asyncio runtime.
+
+Blocking calls (paramiko, requests, ...) are run on a single, bounded thread
+pool shared by the whole process. This is what the default async
+implementations of Transport, State, Command and Trigger use to adapt their
+synchronous counterparts.
+'''
+
+_executor = None
+
+def setup(workers: int = 8):
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+
+    _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='automato-blocking')
+    logger.debug(f'Blocking call pool started with {workers} workers')
+
+async def run_blocking(func, *args, **kwargs):
+    if _executor is None:
+        setup()
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
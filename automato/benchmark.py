@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import http.server
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import yaml
+
+from automato import command_line, scheduler, aio
+from automato.transport import SshTransport
+
+logger = logging.getLogger(__name__)
+
+'''
+Benchmark
+
+Generates endpoints.yml, triggers.yml and actions.yml at a configurable scale
+and runs them against local stand-ins:
+  - FakeSshTransport answers the commands of the builtin states after a
+    configurable latency
+  - a local HTTP server serves JSON for HttpTransport
+
+Reports loop time, action executions per second, action latency and memory.
+'''
+
+FAKE_OUTPUT = {
+    'who': lambda: '\n'.join(['bench pts/0 2026-01-01 00:00'] * random.randint(1, 3)),
+    'cat /proc/loadavg': lambda: f'{random.random():.2f} 0.40 0.30 1/100 1234',
+    'cat /proc/meminfo': lambda: f'MemTotal: 8000000 kB\nMemFree: {random.randint(0, 8000000)} kB\nMemAvailable: 4000000 kB',
+}
+
+'''
+FakeSshTransport behaves like a SshTransport but never connects anywhere.
+Every exec (or batch) waits for `latency` seconds.
+'''
+class FakeSshTransport(SshTransport):
+    def _init(self, latency: float = 0.01, **kwargs):
+        self._latency = latency
+        self._hostname = 'fake'
+
+    def connect(self):
+        self._connected = True
+
+    def isConnected(self) -> bool:
+        return self._connected
+
+    def _output(self, command: str):
+        if command in FAKE_OUTPUT:
+            return (FAKE_OUTPUT[command]().encode('utf-8'), b'', 0)
+
+        return (b'', b'', 0)
+
+    def exec(self, command: str):
+        time.sleep(self._latency)
+        return self._output(command)
+
+    def execBatch(self, commands: list):
+        time.sleep(self._latency)
+        return [self._output(c) for c in commands]
+
+    def execStream(self, command: str, max_bytes: [None,int] = None, timeout: float = 5):
+        time.sleep(self._latency)
+        yield from self._output(command)[0].splitlines()
+
+    def disconnect(self):
+        self._connected = False
+
+class JsonHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps({'value': 42, 'random': random.randint(0, 100)}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def start_http_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), JsonHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+STATES = [
+    ('user', 'automato.state.UserSessionState'),
+    ('load', 'automato.state.LinuxLoadState'),
+    ('mem', 'automato.state.LinuxMemoryState'),
+]
+
+def generate(path: str, args, http_address: str):
+    endpoints = {}
+    for i in range(args.endpoints):
+        endpoints[f'ssh{i}'] = {
+            'info': {},
+            'concurrency': args.concurrency,
+            'transports': {'ssh': {'class': 'automato.benchmark.FakeSshTransport', 'latency': args.latency}},
+            'commands': {'notify': {'class': 'automato.command.NotifyCommand', 'transport': 'ssh'}},
+            'states': {
+                f'{STATES[s % len(STATES)][0]}{s // len(STATES) or ""}': {
+                    'class': STATES[s % len(STATES)][1], 'transport': 'ssh', 'ttl': args.ttl
+                } for s in range(args.states)
+            },
+        }
+
+    for i in range(args.http):
+        endpoints[f'web{i}'] = {
+            'info': {},
+            'concurrency': args.concurrency,
+            'transports': {'web': {'class': 'automato.transport.http.HttpTransport', 'address': http_address}},
+            'commands': {'get': {'class': 'automato.command.http.HttpCommand', 'transport': 'web'}},
+            'states': {'json': {'class': 'automato.state.http.HttpJsonState', 'transport': 'web',
+                                'path': '/data.json', 'method': 'GET', 'ttl': args.ttl}},
+        }
+
+    triggers = {'conditional': {'class': 'automato.trigger.ConditionalTrigger'}}
+
+    actions = {}
+    for i in range(args.actions):
+        # Spread actions over SSH and HTTP endpoints
+        if args.http > 0 and (args.endpoints == 0 or i % 4 == 3):
+            ep = f'web{i % args.http}'
+            when = [f'{ep}.json.value == 42']
+            then = [{f'{ep}.get': {'method': 'GET', 'path': '/'}}]
+        else:
+            ep = f'ssh{i % args.endpoints}'
+            when = [f'{ep}.user.bench > 0'] if args.states > 0 else ['True']
+            then = [{f'{ep}.notify': {'msg': 'benchmark'}}]
+
+        actions[f'action{i}'] = {
+            'trigger': [{'conditional': {'interval': 0, 'when': when}}],
+            'then': then,
+        }
+
+    for name, data in [('endpoints.yml', endpoints), ('triggers.yml', triggers), ('actions.yml', actions)]:
+        with open(os.path.join(path, name), 'w') as f:
+            yaml.safe_dump(data, f)
+
+# Wraps execute/aexecute of every action to record its latency
+def instrument(actions: dict, latencies: list):
+    for act in actions.values():
+        def timed(f=act.execute):
+            start = time.perf_counter()
+            f()
+            latencies.append(time.perf_counter() - start)
+
+        async def atimed(f=act.aexecute):
+            start = time.perf_counter()
+            await f()
+            latencies.append(time.perf_counter() - start)
+
+        act.execute = timed
+        act.aexecute = atimed
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='automato benchmark')
+    parser.add_argument('-e', '--endpoints', type=int, default=50, help='number of SSH endpoints')
+    parser.add_argument('-s', '--states', type=int, default=3, help='number of states per SSH endpoint')
+    parser.add_argument('-a', '--actions', type=int, default=100, help='number of actions')
+    parser.add_argument('--http', type=int, default=5, help='number of HTTP endpoints')
+    parser.add_argument('--latency', type=float, default=0.01, help='latency of the fake SSH transport in seconds')
+    parser.add_argument('--ttl', type=float, default=0, help='TTL of all states')
+    parser.add_argument('--concurrency', type=int, default=1, help='concurrency of every endpoint')
+    parser.add_argument('-r', '--rounds', type=int, default=10, help='number of runs to measure')
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    parser.add_argument('--async', dest='use_async', action='store_true')
+    parser.add_argument('-o', '--output', default=None,
+                        help='directory to write the generated configuration to. Defaults to a temporary directory')
+
+    return parser.parse_args()
+
+def run(args, path: str):
+    _, _, actions = command_line.setup(connect=not args.use_async, path=path)
+
+    latencies = []
+    instrument(actions, latencies)
+
+    # Every round runs all actions
+    sched = scheduler.Scheduler(actions, workers=args.workers, min_looptime=0)
+    loops = []
+
+    async def arun():
+        aio.setup(args.workers)
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            await sched.arun()
+            loops.append(time.perf_counter() - start)
+
+    if args.use_async:
+        asyncio.run(arun())
+    else:
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            sched.run()
+            loops.append(time.perf_counter() - start)
+
+        sched.shutdown()
+
+    total = sum(loops)
+    print(f'endpoints: {args.endpoints} ssh, {args.http} http; states/endpoint: {args.states}; actions: {args.actions}')
+    print(f'loop time:     avg {total / len(loops) * 1000:.1f}ms, max {max(loops) * 1000:.1f}ms')
+    print(f'actions/s:     {len(latencies) / total:.1f}')
+    print(f'action latency p50 {percentile(latencies, 50) * 1000:.1f}ms, p99 {percentile(latencies, 99) * 1000:.1f}ms')
+    print(f'max RSS:       {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MiB')
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s | %(levelname)s | %(name)s - %(message)s',
+                        datefmt='%c')
+
+    server = start_http_server()
+    http_address = f'http://127.0.0.1:{server.server_port}'
+
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+        generate(args.output, args, http_address)
+        run(args, args.output)
+    else:
+        with tempfile.TemporaryDirectory() as path:
+            generate(path, args, http_address)
+            run(args, path)
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from automato import transport
+from automato import aio
 
 import logging
 
@@ -14,6 +15,9 @@ MUST implement:
 
 CAN implement:
   _init(self, transport, ...)
+  aexecute(self, **kwargs)
+    async counterpart of execute(). By default, execute() is run in the
+    blocking call pool.
 
 SHOULDNT implement:
   __init__(self, endpoint_info: dict, **kwargs):
@@ -30,6 +34,9 @@ class Command:
     def execute(self, **kwargs):
         raise NotImplemented
 
+    async def aexecute(self, **kwargs):
+        await aio.run_blocking(self.execute, **kwargs)
+
 class NotifyCommand(Command):
     def _init(self, transport: transport.SshTransport):
         self._transport = transport
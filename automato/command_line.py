@@ -1,17 +1,44 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
 import logging
+import signal
 import time
-import yaml
 
-from automato import endpoint, misc, action
-
-def load_yaml(path : str):
-    # Use a TypeDict here
-    with open(path, 'r') as f:
-        return yaml.safe_load(f)
-
-def setup():
+from automato import config, misc, scheduler, aio, metrics, snapshot, reload
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='automato')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='number of worker threads executing actions')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='run on an asyncio event loop. --workers sets the size of the pool used for blocking calls')
+    parser.add_argument('-l', '--looptime', type=float, default=60,
+                        help='maximum time in seconds between two runs')
+    parser.add_argument('--min-looptime', type=float, default=1,
+                        help='minimum time in seconds between two runs of an action')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve metrics in the Prometheus text format on this port')
+    parser.add_argument('--metrics-address', default='127.0.0.1',
+                        help='address to serve metrics on')
+    parser.add_argument('-s', '--snapshot', default=None,
+                        help='file to save snapshots of the runtime state to. It is restored on startup')
+    parser.add_argument('--snapshot-backend', default='automato.snapshot.FileBackend',
+                        help='class used to store snapshots')
+    parser.add_argument('--snapshot-interval', type=float, default=60,
+                        help='time in seconds between two snapshots')
+    parser.add_argument('-c', '--connect-concurrency', type=int, default=16,
+                        help='number of endpoints connecting in parallel on startup')
+    parser.add_argument('--stagger', action='store_true',
+                        help='spread the first evaluation of triggers and expiry of states randomly over their interval and TTL')
+    parser.add_argument('--watch', action='store_true',
+                        help='reload the configuration when its files change. A reload can always be requested by SIGHUP')
+
+    return parser.parse_args()
+
+def setup(connect: bool = True, path: str = '.', connect_concurrency: int = 16):
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s | %(levelname)s | %(name)s - %(message)s',
                         datefmt='%c')
@@ -19,50 +46,142 @@ def setup():
     logging.getLogger('paramiko').setLevel(logging.WARNING)
     logging.getLogger('urllib3').setLevel(logging.WARNING)
 
-    endpoint_config = load_yaml('endpoints.yml')
-    trigger_config = load_yaml('triggers.yml')
-    action_config = load_yaml('actions.yml')
+    endpoint_config, trigger_config, action_config = config.load(path)
 
-    endpoints = {}
-    for ep_key in endpoint_config:
-        endpoints[ep_key] = endpoint.Endpoint(ep_key, endpoint_config[ep_key])
+    endpoints = config.build_endpoints(endpoint_config)
+    triggers = config.build_triggers(trigger_config, endpoints)
+    actions = config.build_actions(action_config, endpoints, triggers)
 
-    triggers = {}
-    for trg_key in trigger_config:
-        cls = misc.import_class(trigger_config[trg_key]['class'])
-        del trigger_config[trg_key]['class']
+    # TODO should we do that in Endpoint.__init__()?
+    if connect:
+        connect_endpoints(endpoints, connect_concurrency)
 
-        if cls.NEEDS_CONTEXT:
-            triggers[trg_key]  = cls(endpoints, **trigger_config[trg_key])
-        else:
-            triggers[trg_key]  = cls(**trigger_config[trg_key])
+    return endpoints, triggers, actions
 
-    actions = {}
-    for act_key in action_config:
-        actions[act_key] = action.Action(act_key, action_config[act_key], endpoints, triggers)
+# An endpoint failing to connect must not stop the others, eg. on startup or
+# after a reload. Its transports retry when they are used.
+def connect_endpoint(endpoints: dict, k: str):
+    try:
+        endpoints[k].connectTransport()
+    except Exception as e:
+        logging.error(f'Failed to connect endpoint "{k}": {e}')
 
+def connect_endpoints(endpoints: dict, concurrency: int):
+    starttime = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='automato-connect') as executor:
+        list(executor.map(lambda k: connect_endpoint(endpoints, k), endpoints))
 
-    # TODO should we do that in Endpoint.__init__()?
-    # TODO We also need better connectivity handling, eg. auto reconnect
+    logging.debug(f'Connected {len(endpoints)} endpoints in {time.time() - starttime:.2f}s')
+
+async def aconnect_endpoints(endpoints: dict, concurrency: int):
+    starttime = time.time()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def connect(k):
+        async with sem:
+            try:
+                await endpoints[k].aconnectTransport()
+            except Exception as e:
+                logging.error(f'Failed to connect endpoint "{k}": {e}')
+
+    await asyncio.gather(*[connect(k) for k in endpoints])
+    logging.debug(f'Connected {len(endpoints)} endpoints in {time.time() - starttime:.2f}s')
+
+# Spreads the phases of states and trigger instances, so they do not all
+# become due at the same time.
+def stagger(endpoints: dict, triggers: dict):
     for k in endpoints:
-        endpoints[k].connectTransport()
+        endpoints[k].stagger()
+
+    for k in triggers:
+        triggers[k].stagger()
+
+def setup_snapshot(args, endpoints: dict, triggers: dict, actions: dict):
+    if args.snapshot is None:
+        return None
+
+    backend = misc.import_class(args.snapshot_backend)(args.snapshot)
+    snap = snapshot.Snapshot(backend, endpoints, triggers, actions, interval=args.snapshot_interval)
+    snap.restore()
+
+    return snap
 
-    return actions
+def wait_time(starttime: float, next_run: float) -> float:
+    now = time.time()
+    wait = max(0, next_run - now)
+    metrics.LOOP.observe(now - starttime)
+    logging.debug(f'Loop took {now - starttime:.2f}s. Waiting {wait:.2f}s before next run.')
+    if now - next_run > 1:
+        logging.warn(f'System seems overloaded. Actions are running {now - next_run:.2f}s late.')
+
+    return wait
+
+async def main_async(args):
+    endpoints, triggers, actions = setup(connect=False)
+    aio.setup(args.workers)
+    snap = setup_snapshot(args, endpoints, triggers, actions)
+    if args.stagger:
+        stagger(endpoints, triggers)
+
+    await aconnect_endpoints(endpoints, args.connect_concurrency)
+
+    sched = scheduler.Scheduler(actions, looptime=args.looptime, min_looptime=args.min_looptime)
+
+    reloader = reload.Reloader('.', endpoints, triggers, actions, watch=args.watch)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reloader.request)
+
+    try:
+        while True:
+            starttime = time.time()
+
+            if reloader.pending():
+                built = reloader.reload()
+                await aconnect_endpoints({k: endpoints[k] for k in built}, args.connect_concurrency)
+                sched.reset()
+
+            next_run = await sched.arun()
+            if snap is not None:
+                snap.checkpoint()
+
+            await asyncio.sleep(wait_time(starttime, next_run))
+    finally:
+        if snap is not None:
+            snap.save()
 
 def main():
-    actions = setup()
+    args = parse_args()
+
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port, args.metrics_address)
+
+    if args.use_async:
+        asyncio.run(main_async(args))
+        return
+
+    endpoints, triggers, actions = setup(connect_concurrency=args.connect_concurrency)
+    snap = setup_snapshot(args, endpoints, triggers, actions)
+    if args.stagger:
+        stagger(endpoints, triggers)
+
+    sched = scheduler.Scheduler(actions, workers=args.workers, looptime=args.looptime, min_looptime=args.min_looptime)
+
+    reloader = reload.Reloader('.', endpoints, triggers, actions, watch=args.watch)
+    reloader.installSignalHandler()
 
-    looptime = 5 # TODO
-    while True:
-        starttime = time.time()
+    try:
+        while True:
+            starttime = time.time()
 
-        for act_key in actions:
-            actions[act_key].execute()
+            if reloader.pending():
+                built = reloader.reload()
+                connect_endpoints({k: endpoints[k] for k in built}, args.connect_concurrency)
+                sched.reset()
 
-        elapsed = time.time() - starttime
-        wait = max(0, looptime - elapsed)
-        logging.debug(f'Loop took {elapsed:.2f}s. Waiting {wait:.2f}s before next run.')
-        if wait <= 0.1 * looptime:
-            logging.warn(f'System seems overloaded. Actions did not run in specified looptime {looptime}s.')
+            next_run = sched.run()
+            if snap is not None:
+                snap.checkpoint()
 
-        time.sleep(max(0, looptime - elapsed))
+            time.sleep(wait_time(starttime, next_run))
+    finally:
+        if snap is not None:
+            snap.save()
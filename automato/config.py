@@ -0,0 +1,65 @@
+import copy
+import logging
+import os
+import yaml
+
+from automato import endpoint, misc, action
+
+logger = logging.getLogger(__name__)
+
+'''
+Loading of endpoints.yml, triggers.yml and actions.yml and construction
+of the objects they describe.
+'''
+
+FILES = ['endpoints.yml', 'triggers.yml', 'actions.yml']
+
+def load_yaml(path : str):
+    # Use a TypeDict here
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+# returns (endpoint_config, trigger_config, action_config)
+def load(path: str = '.'):
+    return tuple([load_yaml(os.path.join(path, f)) or {} for f in FILES])
+
+# Endpoints with a 'class' (eg. automato.fleet.Fleet) may refer to other
+# endpoints and are built after all plain ones
+def needs_context(ep_cfg: dict) -> bool:
+    return 'class' in ep_cfg
+
+def build_endpoint(ep_key: str, ep_cfg: dict, endpoints: dict):
+    ep_cfg = copy.deepcopy(ep_cfg)
+    cls = misc.import_class(ep_cfg.pop('class')) if 'class' in ep_cfg else endpoint.Endpoint
+
+    if cls.NEEDS_CONTEXT:
+        return cls(ep_key, ep_cfg, endpoints)
+
+    return cls(ep_key, ep_cfg)
+
+def build_endpoints(endpoint_config: dict) -> dict:
+    endpoints = {}
+    for ep_key in sorted(endpoint_config, key=lambda k: needs_context(endpoint_config[k])):
+        endpoints[ep_key] = build_endpoint(ep_key, endpoint_config[ep_key], endpoints)
+
+    return endpoints
+
+def build_triggers(trigger_config: dict, endpoints: dict) -> dict:
+    triggers = {}
+    for trg_key in trigger_config:
+        trg_cfg = dict(trigger_config[trg_key])
+        cls = misc.import_class(trg_cfg.pop('class'))
+
+        if cls.NEEDS_CONTEXT:
+            triggers[trg_key]  = cls(endpoints, **trg_cfg)
+        else:
+            triggers[trg_key]  = cls(**trg_cfg)
+
+    return triggers
+
+def build_actions(action_config: dict, endpoints: dict, triggers: dict) -> dict:
+    actions = {}
+    for act_key in action_config:
+        actions[act_key] = action.Action(act_key, copy.deepcopy(action_config[act_key]), endpoints, triggers)
+
+    return actions
@@ -1,91 +1,189 @@
+import asyncio
 import logging
+import threading
+import time
 logger = logging.getLogger(__name__)
 
 from automato import transport
+from automato import misc
+from automato import metrics
+from automato import aio
+from automato.state import CommandState
 
-def import_class(cl):
-    d = cl.rfind(".")
-    classname = cl[d+1:len(cl)]
-    m = __import__(cl[0:d], globals(), locals(), [classname])
-    return getattr(m, classname)
+'''
+Endpoint
 
-    # Master object
+Transports, commands and states are only constructed on first use,
+so only what is referenced by actions is loaded. A transport is constructed
+together with the first command or state using it.
+'''
 class Endpoint:
+    NEEDS_CONTEXT = False
+
     def __init__(self, name: str, config: dict):
-        transports = {}
-        commands = {}
-        states = {}
+        self._name = name
+        self._endpoint_info = config.get('info', {})
+
+        self._transport_cfg = config.get('transports', {})
+        self._command_cfg = config.get('commands', {})
+        self._state_cfg = config.get('states', {})
 
-        endpoint_info = config.get('info', {})
+        self._transports = {}
+        self._commands = {}
+        self._states = {}
 
-        # sweet mother of jesus, you are ugly
-        for tp_key in config['transports']:
-            tp_cfg = config['transports'][tp_key]
-            logger.debug(f'loading transport "{tp_key}"')
+        # Snapshots of states which were not constructed yet
+        self._pending_snapshots = {}
+        self._connected = False
+        # Transports built after the endpoint was connected, connected by
+        # the first caller using them, outside of _build_lock
+        self._unconnected = []
+        self._build_lock = threading.RLock()
 
-            # TODO Handle failure
-            tp_class = import_class(tp_cfg['class'])
-            del tp_cfg['class']
+        # Limits how many workers may use this endpoint at the same time
+        self._concurrency = config.get('concurrency', 1)
+        self._lock = threading.BoundedSemaphore(self._concurrency)
+        self._alock = None
 
-            transports[tp_key] = tp_class(endpoint_info, **tp_cfg)
+    def name(self) -> str:
+        return self._name
+
+    # A transport failing to connect must not stop the others. It is
+    # retried, or fails, when it is used.
+    def _connect(self, key: str):
+        try:
+            if   self._transports[key].CONNECTION == transport.HOLD:
+                self._transports[key].connect()
+            elif self._transports[key].CONNECTION == transport.THROWAWAY:
+                self._transports[key].check()
+            else:
+                logger.error(f'"{self._transports[key].CONNECTION}" is an unknown connection type in transport "{key}"')
+        except Exception as e:
+            logger.error(f'Failed to connect transport "{key}" of "{self._name}": {e}')
 
-        for cmd_key in config['commands']:
-            cmd_cfg = config['commands'][cmd_key]
-            logger.debug(f'loading command "{cmd_key}"')
+    async def _aconnect(self, key: str):
+        try:
+            if   self._transports[key].CONNECTION == transport.HOLD:
+                await self._transports[key].aconnect()
+            elif self._transports[key].CONNECTION == transport.THROWAWAY:
+                await self._transports[key].acheck()
+            else:
+                logger.error(f'"{self._transports[key].CONNECTION}" is an unknown connection type in transport "{key}"')
+        except Exception as e:
+            logger.error(f'Failed to connect transport "{key}" of "{self._name}": {e}')
 
-            # TODO Handle failure
-            cmd_class = import_class(cmd_cfg['class'])
-            del cmd_cfg['class']
+    def _popUnconnected(self) -> list:
+        with self._build_lock:
+            keys, self._unconnected = self._unconnected, []
 
-            if 'transport' in cmd_cfg:
-                if cmd_cfg['transport'] not in transports:
-                    # TODO should we be lenient with errors?
-                    logger.error(f'transport "{cmd_cfg["transport"]}" for command "{cmd_key}" was not found.')
-                    continue
+        return keys
 
-                tp = transports[cmd_cfg['transport']]
-                del cmd_cfg['transport']
-                cmd_cfg['transport'] = tp
+    def _connectNew(self):
+        for k in self._popUnconnected():
+            self._connect(k)
 
-            commands[cmd_key] = cmd_class(endpoint_info, **cmd_cfg)
+    # In async mode, connecting must not block the event loop
+    async def _aconnectNew(self):
+        for k in self._popUnconnected():
+            await self._aconnect(k)
 
-        # you look familiar
-        for stt_key in config['states']:
-            stt_cfg = config['states'][stt_key]
-            logger.debug(f'loading state "{stt_key}"')
+    # Constructs the class in 'config' with the transport it references
+    def _build(self, kind: str, key: str, config: dict):
+        logger.debug(f'loading {kind} "{key}"')
+        cfg = dict(config)
 
-            # TODO Handle failure
-            stt_class = import_class(stt_cfg['class'])
-            del stt_cfg['class']
+        # TODO Handle failure
+        cls = misc.import_class(cfg.pop('class'))
 
-            if stt_cfg['transport'] not in transports:
+        if 'transport' in cfg:
+            tp = self._getTransport(cfg['transport'])
+            if tp is None:
                 # TODO should we be lenient with errors?
-                logger.error(f'transport "{stt_cfg["transport"]}" for command "{stt_key}" was not found.')
-                continue
+                logger.error(f'transport "{cfg["transport"]}" for {kind} "{key}" was not found.')
+                return None
 
-            if 'transport' in stt_cfg:
-                tp = transports[stt_cfg['transport']]
-                del stt_cfg['transport']
-                stt_cfg['transport'] = tp
+            cfg['transport'] = tp
 
-            states[stt_key] = stt_class(endpoint_info, **stt_cfg)
+        return cls(self._endpoint_info, **cfg)
 
-        # TODO How does the init step look like? Do it here?
-        # transports prbly need to be connected here
+    def _getTransport(self, key: str):
+        with self._build_lock:
+            if key not in self._transports:
+                if key not in self._transport_cfg:
+                    return None
 
-        self._name = name
-        self._transports = transports
-        self._commands = commands
-        self._states = states
+                cfg = dict(self._transport_cfg[key])
+                logger.debug(f'loading transport "{key}"')
+                self._transports[key] = misc.import_class(cfg.pop('class'))(self._endpoint_info, **cfg)
+
+                # Transports used for the first time after the endpoint was connected
+                if self._connected:
+                    self._unconnected.append(key)
+
+            return self._transports[key]
+
+    def _getCommand(self, key: str):
+        with self._build_lock:
+            if key not in self._commands and key in self._command_cfg:
+                cmd = self._build('command', key, self._command_cfg[key])
+                if cmd is not None:
+                    self._commands[key] = cmd
+
+            return self._commands.get(key)
+
+    def _getState(self, key: str):
+        with self._build_lock:
+            if key not in self._states and key in self._state_cfg:
+                stt = self._build('state', key, self._state_cfg[key])
+                if stt is not None:
+                    stt.setName(self._name, key)
+                    if key in self._pending_snapshots:
+                        stt.loadSnapshot(self._pending_snapshots.pop(key))
+
+                    self._states[key] = stt
+
+            stt = self._states.get(key)
+
+        if stt is None:
+            logger.error(f'State "{key}" was not found for "{self._name}"')
+
+        return stt
 
     def connectTransport(self):
-        for k in self._transports:
-            if   self._transports[k].CONNECTION == transport.HOLD:
-                self._transports[k].connect()
-            elif self._transports[k].CONNECTION == transport.THROWAWAY:
-                self._transports[k].check()
-            else:
-                logger.error(f'"{self._transports[k].CONNECTION}" is an unknown connection type in transport "{k}"')
+        with self._build_lock:
+            self._connected = True
+            self._unconnected = []
+            transports = list(self._transports)
+
+        for k in transports:
+            self._connect(k)
+
+    def disconnectTransport(self):
+        with self._build_lock:
+            self._connected = False
+            self._unconnected = []
+            transports = list(self._transports)
+
+        for k in transports:
+            if self._transports[k].CONNECTION == transport.HOLD:
+                self._transports[k].disconnect()
+
+    async def aconnectTransport(self):
+        with self._build_lock:
+            self._connected = True
+            self._unconnected = []
+            transports = list(self._transports)
+
+        for k in transports:
+            await self._aconnect(k)
+
+    # asyncio counterpart of _lock. Created on first use, so it belongs to
+    # the running event loop.
+    def _asyncLock(self):
+        if self._alock is None:
+            self._alock = asyncio.BoundedSemaphore(self._concurrency)
+
+        return self._alock
 
     # forces a recollect of all states. should not be needed, states should
     # handle that themselves via TTL
@@ -95,20 +193,228 @@ class Endpoint:
     #    for k in self._states:
     #        self._states[k].collect()
 
+    # Collection planner: if 'state' is due, all other due CommandStates on
+    # the same transport are collected with it in a single batch.
+    # returns (transport, [states]), or (None, []) if there is nothing to batch.
+    def _planCollection(self, state: str):
+        stt = self._states[state]
+        if not isinstance(stt, CommandState) or not stt.isDue():
+            return None, []
+
+        tp = stt.getTransport()
+        if not hasattr(tp, 'execBatch'):
+            return None, []
+
+        due = [s for s in list(self._states.values())
+               if isinstance(s, CommandState) and s.getTransport() is tp and s.isDue()]
+
+        if len(due) < 2:
+            return None, []
+
+        logger.debug(f'Collecting {len(due)} states of "{self._name}" in one batch')
+        return tp, due
+
+    # The time the batch took is split evenly between its states.
+    # returns the states which were collected
+    def _distributeBatch(self, due: list, results: list, elapsed: float) -> list:
+        collected = []
+        for stt, (stdout, stderr, retcode) in zip(due, results):
+            if retcode != 0:
+                # The state stays due and will be collected on its own
+                logger.error(f'Command returned error {retcode}: {stderr}')
+                continue
+
+            # A failing state must not fail the others. It stays due as well.
+            try:
+                stt.collectOutput(stdout, elapsed / len(due))
+            except Exception as e:
+                logger.error(f'Failed to collect a state of "{self._name}" in a batch: {e}')
+                continue
+
+            collected.append(stt)
+
+        return collected
+
+    # States already collected by another reader are left out of the batch.
+    # returns True, if 'state' was collected by the batch
+    def _collectBatch(self, state: str) -> bool:
+        tp, due = self._planCollection(state)
+        due = [s for s in due if s.claimCollection()]
+
+        try:
+            if len(due) < 2:
+                return False
+
+            start = time.perf_counter()
+            results = tp.execBatch([s.COMMAND for s in due])
+            return self._states[state] in self._distributeBatch(due, results, time.perf_counter() - start)
+        finally:
+            for s in due:
+                s.releaseCollection()
+
+    async def _acollectBatch(self, state: str) -> bool:
+        tp, due = self._planCollection(state)
+        due = [s for s in due if await s.aclaimCollection()]
+
+        try:
+            if len(due) < 2:
+                return False
+
+            start = time.perf_counter()
+            results = await tp.aexecBatch([s.COMMAND for s in due])
+            return self._states[state] in self._distributeBatch(due, results, time.perf_counter() - start)
+        finally:
+            for s in due:
+                await s.areleaseCollection()
+
     # Format: <state>.<key>
     def getState(self, state_key: str):
         state, key = state_key.split('.', 1)
 
-        if state not in self._states:
-            logger.error(f'State "{state}" was not found for "{self._name}"')
+        stt = self._getState(state)
+        if stt is None:
+            return None
+
+        self._connectNew()
+        # A read right after the batch was no cache hit, the batch counted the miss
+        with self._lock:
+            if self._collectBatch(state):
+                return stt.peek(key)
+            return stt.get(key)
+
+
+    async def agetState(self, state_key: str):
+        state, key = state_key.split('.', 1)
+
+        stt = self._getState(state)
+        if stt is None:
+            return None
+
+        await self._aconnectNew()
+        async with self._asyncLock():
+            if await self._acollectBatch(state):
+                return stt.peek(key)
+            return await stt.aget(key)
+
+    # Calls func(transport) with the transport 'key' of this endpoint,
+    # within its concurrency limit. Used by fleets.
+    def withTransport(self, key: str, func):
+        tp = self._getTransport(key)
+        if tp is None:
+            logger.error(f'Transport "{key}" was not found for "{self._name}"')
+            return None
+
+        self._connectNew()
+        with self._lock:
+            return func(tp)
+
+    # func is run on executor, or the blocking call pool
+    async def awithTransport(self, key: str, func, executor = None):
+        tp = self._getTransport(key)
+        if tp is None:
+            logger.error(f'Transport "{key}" was not found for "{self._name}"')
+            return None
+
+        await self._aconnectNew()
+        async with self._asyncLock():
+            if executor is None:
+                return await aio.run_blocking(func, tp)
+
+            return await asyncio.get_running_loop().run_in_executor(executor, func, tp)
+
+    # History of <state>.<key>, see State.history()
+    def getHistory(self, state_key: str):
+        state, key = state_key.split('.', 1)
+
+        stt = self._getState(state)
+        if stt is None:
             return None
 
-        return self._states[state].get(key)
+        return stt.history(key)
+
+    # Collects the state, if its TTL expired
+    def refreshState(self, state: str):
+        stt = self._getState(state)
+        if stt is None:
+            return
+
+        self._connectNew()
+        with self._lock:
+            if not self._collectBatch(state):
+                stt.refresh()
+
+    async def arefreshState(self, state: str):
+        stt = self._getState(state)
+        if stt is None:
+            return
+
+        await self._aconnectNew()
+        async with self._asyncLock():
+            if not await self._acollectBatch(state):
+                await stt.arefresh()
+
+    def stagger(self):
+        for k in self._states:
+            self._states[k].stagger()
+
+    def dumpSnapshot(self) -> dict:
+        with self._build_lock:
+            snapshot = dict(self._pending_snapshots)
+            snapshot.update({k: self._states[k].dumpSnapshot() for k in self._states})
+
+        return snapshot
+
+    def loadSnapshot(self, snapshot: dict):
+        with self._build_lock:
+            for k in snapshot:
+                if k in self._states:
+                    self._states[k].loadSnapshot(snapshot[k])
+                elif k in self._state_cfg:
+                    self._pending_snapshots[k] = snapshot[k]
 
+    # listener(changed: set) is called when a collection changed the state
+    def addStateListener(self, state: str, listener):
+        stt = self._getState(state)
+        if stt is None:
+            return
+
+        stt.addListener(listener)
+
+    def removeStateListener(self, state: str, listener):
+        with self._build_lock:
+            stt = self._states.get(state)
+
+        if stt is not None:
+            stt.removeListener(listener)
+
+    # Checks the configuration only, without building the command
+    def hasCommand(self, cmd: str) -> bool:
+        if cmd not in self._command_cfg:
+            return False
+
+        tp = self._command_cfg[cmd].get('transport')
+        if tp is not None and tp not in self._transport_cfg:
+            logger.error(f'transport "{tp}" for command "{cmd}" was not found.')
+            return False
+
+        return True
 
     def executeCommand(self, cmd: str, **kwargs):
-        if cmd not in self._commands:
+        command = self._getCommand(cmd)
+        if command is None:
             logger.error(f'Command "{cmd}" is not defined for "{self._name}"')
             #raise Exception(f'Command "{cmd}" is not defined for "{self._name}"')
 
-        self._commands[cmd].execute(**kwargs)
+        self._connectNew()
+        with self._lock, metrics.COMMAND_EXECUTE.time(endpoint=self._name, command=cmd):
+            command.execute(**kwargs)
+
+    async def aexecuteCommand(self, cmd: str, **kwargs):
+        command = self._getCommand(cmd)
+        if command is None:
+            logger.error(f'Command "{cmd}" is not defined for "{self._name}"')
+
+        await self._aconnectNew()
+        async with self._asyncLock():
+            with metrics.COMMAND_EXECUTE.time(endpoint=self._name, command=cmd):
+                await command.aexecute(**kwargs)
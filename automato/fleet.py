@@ -0,0 +1,298 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import asyncio
+import fnmatch
+import logging
+import operator
+import threading
+
+from automato import misc
+from automato.state import State
+
+logger = logging.getLogger(__name__)
+
+'''
+Fleets collect the same state of many endpoints at once.
+
+A fleet is configured in endpoints.yml like an endpoint, with the endpoints
+it spans as `members` (names or patterns like 'web*'). Its states are
+defined once and collected from every member, using the member's transport
+of the given name, on a pool of `workers` threads:
+
+```yaml
+web:
+  class: automato.fleet.Fleet
+  members: ['web*']
+  workers: 16
+  states:
+    load:
+      class: automato.state.LinuxLoadState
+      transport: ssh
+      ttl: 30
+```
+
+The results are stored in a table per state, with one column per key and
+one row per member. In conditions, `web.load.1` evaluates to such a Column.
+Operators, including and, or and not, apply to every row, and the aggregates count, sum, any, all, avg,
+min and max reduce a Column to a single value, eg. `count(web.load.1 > 4) > 2`.
+Members that failed to collect are None and are left out of aggregates.
+
+Commands of a fleet are executed on all members, eg. `web.notify`.
+Fleets do not connect transports, their members do.
+'''
+
+'''
+Column holds the values of a key for all members of a fleet.
+'''
+class Column:
+    __hash__ = None
+
+    def __init__(self, values: list):
+        self.values = values
+
+    def _apply(self, op, other, reflected: bool = False):
+        if isinstance(other, Column):
+            pairs = zip(self.values, other.values)
+        else:
+            pairs = [(v, other) for v in self.values]
+
+        return Column([
+            None if a is None or b is None else op(b, a) if reflected else op(a, b) for a, b in pairs
+        ])
+
+    def map(self, op):
+        return Column([None if v is None else op(v) for v in self.values])
+
+    # Conditions have to reduce a Column, eg. by count() or any()
+    def __bool__(self):
+        raise TypeError('Values of a fleet have to be reduced to a single value, eg. by count() or any()')
+
+    def __repr__(self):
+        return f'Column({self.values})'
+
+for _name, _op in [('eq', operator.eq), ('gt', operator.gt), ('ge', operator.ge),
+                   ('lt', operator.lt), ('le', operator.le), ('add', operator.add),
+                   ('sub', operator.sub), ('mul', operator.mul), ('truediv', operator.truediv)]:
+    setattr(Column, f'__{_name}__', lambda self, other, op=_op: self._apply(op, other))
+    if _name in ['add', 'sub', 'mul', 'truediv']:
+        setattr(Column, f'__r{_name}__', lambda self, other, op=_op: self._apply(op, other, True))
+
+def _values(column) -> list:
+    values = column.values if isinstance(column, Column) else [column]
+    return [v for v in values if v is not None]
+
+AGGREGATES = {
+    'count': lambda v: len([x for x in v if x]),
+    'sum':   lambda v: sum(v),
+    'any':   lambda v: any(v),
+    'all':   lambda v: all(v),
+    'avg':   lambda v: sum(v) / len(v) if v else None,
+    'min':   lambda v: min(v) if v else None,
+    'max':   lambda v: max(v) if v else None,
+}
+
+def aggregate(function: str, column):
+    return AGGREGATES[function](_values(column))
+
+'''
+FleetState collects a state from every member of a fleet. It uses one
+instance of the configured state class per worker thread to collect, see
+State.collectFrom().
+'''
+class FleetState(State):
+    def _init(self, fleet, cls, transport: str, **kwargs):
+        self._fleet = fleet
+        self._cls = cls
+        self._transport_key = transport
+        self._state_args = kwargs
+        self._collectors = threading.local()
+        self._data = {}
+        self._members = []
+
+    def _collector(self) -> State:
+        if not hasattr(self._collectors, 'state'):
+            self._collectors.state = self._cls(self._endpoint_info, transport=None, **self._state_args)
+
+        return self._collectors.state
+
+    def _collectMember(self, transport) -> [None,dict]:
+        return self._collector().collectFrom(transport)
+
+    def _fetch(self, member) -> [None,dict]:
+        try:
+            return member.withTransport(self._transport_key, self._collectMember)
+        except Exception as e:
+            logger.error(f'Failed to collect fleet state from "{member.name()}": {e}')
+            return None
+
+    async def _afetch(self, member) -> [None,dict]:
+        try:
+            return await member.awithTransport(self._transport_key, self._collectMember, self._fleet.pool())
+        except Exception as e:
+            logger.error(f'Failed to collect fleet state from "{member.name()}": {e}')
+            return None
+
+    # Stores the rows of all members as columns
+    def _store(self, members: list, rows: list):
+        keys = {}
+        for row in rows:
+            keys.update(dict.fromkeys(row or {}))
+
+        self._members = [m.name() for m in members]
+        self._data = {k: [row.get(k) if row is not None else None for row in rows] for k in keys}
+
+    def _collect(self):
+        members = self._fleet.members()
+        rows = list(self._fleet.pool().map(self._fetch, members))
+        self._store(members, rows)
+
+    async def _acollect(self):
+        members = self._fleet.members()
+        self._store(members, await asyncio.gather(*[self._afetch(m) for m in members]))
+
+    def _get(self, key: str):
+        if key not in self._data:
+            return Column([None] * len(self._members))
+
+        return Column(self._data[key])
+
+    def dumpSnapshot(self) -> dict:
+        return {'members': self._members, 'data': self._data, 'last_collected': self._last_collected}
+
+    def loadSnapshot(self, snapshot: dict):
+        if snapshot.get('members') != [m.name() for m in self._fleet.members()]:
+            logger.debug('Ignoring snapshot of different fleet members')
+            return
+
+        super().loadSnapshot(snapshot)
+        self._members = snapshot['members']
+
+class Fleet:
+    NEEDS_CONTEXT = True
+
+    def __init__(self, name: str, config: dict, endpoints: dict):
+        self._name = name
+        self._endpoint_info = config.get('info', {})
+        self._workers = config.get('workers', 16)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+        self._members = []
+        for pattern in config.get('members', []):
+            matched = [endpoints[k] for k in endpoints if fnmatch.fnmatchcase(k, pattern) and not endpoints[k].NEEDS_CONTEXT]
+            if not matched:
+                logger.error(f'Fleet "{name}": member "{pattern}" does not match any endpoint')
+
+            self._members += [m for m in matched if m not in self._members]
+
+        self._states = {}
+        for key, state_cfg in config.get('states', {}).items():
+            cfg = dict(state_cfg)
+            cls = misc.import_class(cfg.pop('class'))
+            ttl = cfg.pop('ttl', 30)
+            grace = cfg.pop('grace', 0)
+
+            self._states[key] = FleetState(self._endpoint_info, ttl=ttl, grace=grace, fleet=self, cls=cls, **cfg)
+            self._states[key].setName(name, key)
+
+        logger.debug(f'Fleet "{name}" has {len(self._members)} members')
+
+    def name(self) -> str:
+        return self._name
+
+    def members(self) -> list:
+        return self._members
+
+    def pool(self) -> ThreadPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix=f'automato-fleet-{self._name}')
+
+        return self._pool
+
+    def _getState(self, state: str):
+        if state not in self._states:
+            logger.error(f'State "{state}" was not found for "{self._name}"')
+            return None
+
+        return self._states[state]
+
+    # Format: <state>.<key>
+    def getState(self, state_key: str):
+        state, key = state_key.split('.', 1)
+
+        stt = self._getState(state)
+        return stt.get(key) if stt is not None else None
+
+    async def agetState(self, state_key: str):
+        state, key = state_key.split('.', 1)
+
+        stt = self._getState(state)
+        return await stt.aget(key) if stt is not None else None
+
+    def getHistory(self, state_key: str):
+        logger.error(f'Fleet "{self._name}" does not keep a history')
+        return None
+
+    def refreshState(self, state: str):
+        stt = self._getState(state)
+        if stt is not None:
+            stt.refresh()
+
+    async def arefreshState(self, state: str):
+        stt = self._getState(state)
+        if stt is not None:
+            await stt.arefresh()
+
+    def addStateListener(self, state: str, listener):
+        stt = self._getState(state)
+        if stt is not None:
+            stt.addListener(listener)
+
+    def removeStateListener(self, state: str, listener):
+        if state in self._states:
+            self._states[state].removeListener(listener)
+
+    def hasCommand(self, cmd: str) -> bool:
+        missing = [m.name() for m in self._members if not m.hasCommand(cmd)]
+        if missing:
+            logger.error(f'Fleet "{self._name}": Command "{cmd}" is not defined for {missing}')
+
+        return not missing
+
+    def executeCommand(self, cmd: str, **kwargs):
+        futures = {self.pool().submit(m.executeCommand, cmd, **kwargs): m for m in self._members}
+        wait(futures)
+
+        for f in futures:
+            if f.exception() is not None:
+                logger.error(f'Fleet "{self._name}": Command "{cmd}" failed on "{futures[f].name()}": {f.exception()}')
+
+    async def aexecuteCommand(self, cmd: str, **kwargs):
+        results = await asyncio.gather(*[m.aexecuteCommand(cmd, **kwargs) for m in self._members], return_exceptions=True)
+
+        for m, r in zip(self._members, results):
+            if isinstance(r, Exception):
+                logger.error(f'Fleet "{self._name}": Command "{cmd}" failed on "{m.name()}": {r}')
+
+    def connectTransport(self):
+        pass
+
+    async def aconnectTransport(self):
+        pass
+
+    def disconnectTransport(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def stagger(self):
+        for k in self._states:
+            self._states[k].stagger()
+
+    def dumpSnapshot(self) -> dict:
+        return {k: self._states[k].dumpSnapshot() for k in self._states}
+
+    def loadSnapshot(self, snapshot: dict):
+        for k in snapshot:
+            if k in self._states:
+                self._states[k].loadSnapshot(snapshot[k])
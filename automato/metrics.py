@@ -0,0 +1,161 @@
+import bisect
+import contextlib
+import http.server
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+'''
+Metrics
+
+Counters and histograms of the hot paths, labelled by endpoint, state,
+command and action. They can be exposed in the Prometheus text format
+by a builtin HTTP server, see serve().
+'''
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    labels = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        labels.append(extra)
+
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self._name = name
+        self._help = help
+        self._labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple([labels.get(l, '') for l in self._labels])
+
+    def _expose(self) -> list:
+        raise NotImplemented
+
+    def expose(self) -> str:
+        lines = [f'# HELP {self._name} {self._help}', f'# TYPE {self._name} {self.TYPE}']
+        with self._lock:
+            lines += self._expose()
+
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _expose(self) -> list:
+        return [f'{self._name}{_format_labels(self._labels, k)} {v}' for k, v in self._values.items()]
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self._buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                # [counts per bucket, sum, count]
+                self._values[key] = [[0] * len(self._buckets), 0, 0]
+
+            data = self._values[key]
+            i = bisect.bisect_left(self._buckets, value)
+            if i < len(self._buckets):
+                data[0][i] += 1
+            data[1] += value
+            data[2] += 1
+
+    # Observes the time spent in the with block, even if it raised
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _expose(self) -> list:
+        lines = []
+        for k, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for le, c in zip(self._buckets, counts):
+                cumulative += c
+                labels = _format_labels(self._labels, k, f'le="{le}"')
+                lines.append(f'{self._name}_bucket{labels} {cumulative}')
+
+            labels = _format_labels(self._labels, k, 'le="+Inf"')
+            lines.append(f'{self._name}_bucket{labels} {count}')
+            lines.append(f'{self._name}_sum{_format_labels(self._labels, k)} {total}')
+            lines.append(f'{self._name}_count{_format_labels(self._labels, k)} {count}')
+
+        return lines
+
+def expose() -> str:
+    return '\n'.join([m.expose() for m in _registry]) + '\n'
+
+STATE_COLLECT = Histogram('automato_state_collect_seconds',
+                          'Time spent collecting a state', ('endpoint', 'state'))
+STATE_CACHE = Counter('automato_state_cache_total',
+                      'Reads of a state: served from cache (hit), collected (miss), collected by a concurrent reader (coalesced) '
+                      'or served stale during a concurrent collection (stale)', ('endpoint', 'state', 'result'))
+TRIGGER_EVALUATE = Histogram('automato_trigger_evaluate_seconds',
+                             'Time spent evaluating a trigger instance', ('trigger', 'action'))
+ACTION_EXECUTE = Histogram('automato_action_execute_seconds',
+                           'Time spent executing an action, including its triggers', ('action',))
+COMMAND_EXECUTE = Histogram('automato_command_execute_seconds',
+                            'Time spent executing a command', ('endpoint', 'command'))
+COMMAND_RESULT = Counter('automato_command_results_total',
+                         'Results of commands run by actions: ok, failed, timeout or skipped', ('endpoint', 'command', 'result'))
+TRANSPORT_REQUEST = Histogram('automato_transport_request_seconds',
+                              'Time spent in a single transport request', ('transport', 'host'))
+PUSH_RECEIVED = Counter('automato_push_messages_total',
+                        'State updates pushed by agents', ('agent',))
+LOOP = Histogram('automato_loop_seconds', 'Time a run of the scheduler took')
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+# Serves all metrics on http://<address>:<port>/metrics in a background thread
+def serve(port: int, address: str = '127.0.0.1'):
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name='automato-metrics').start()
+    logger.info(f'Serving metrics on {address}:{port}')
+
+    return server
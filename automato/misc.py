@@ -1,6 +1,15 @@
+import threading
+
+# Resolved classes, keyed by their full name
+_classes = {}
+_classes_lock = threading.Lock()
 
 def import_class(cl):
-    d = cl.rfind(".")
-    classname = cl[d+1:len(cl)]
-    m = __import__(cl[0:d], globals(), locals(), [classname])
-    return getattr(m, classname)
+    with _classes_lock:
+        if cl not in _classes:
+            d = cl.rfind(".")
+            classname = cl[d+1:len(cl)]
+            m = __import__(cl[0:d], globals(), locals(), [classname])
+            _classes[cl] = getattr(m, classname)
+
+        return _classes[cl]
@@ -0,0 +1,125 @@
+import logging
+import os
+import signal
+
+from automato import config
+
+logger = logging.getLogger(__name__)
+
+'''
+Reloader applies changes to the configuration files without a restart.
+
+The new configuration is compared to the running one:
+  - Endpoints with unchanged configuration are kept as they are, with their
+    connected transports and collected states. Changed and new endpoints are
+    rebuilt, changed and removed ones are disconnected. Fleets are rebuilt
+    if any endpoint was.
+  - Triggers and actions are cheap to build and are always rebuilt.
+    Unchanged actions keep their last run and the last results of their
+    trigger instances.
+
+The running objects are updated in place, so everyone holding the endpoints,
+triggers and actions dictionaries sees the new configuration.
+A reload is requested by SIGHUP or, if watching, by changed files, and is
+performed by the main loop between two runs.
+'''
+class Reloader:
+    def __init__(self, path: str, endpoints: dict, triggers: dict, actions: dict, watch: bool = False):
+        self._path = path
+        self._endpoints = endpoints
+        self._triggers = triggers
+        self._actions = actions
+        self._watch = watch
+
+        self._requested = False
+        self._endpoint_cfg, self._trigger_cfg, self._action_cfg = config.load(path)
+        self._mtimes = self._readMtimes()
+
+    def _readMtimes(self) -> list:
+        return [os.stat(os.path.join(self._path, f)).st_mtime for f in config.FILES]
+
+    def request(self, *args):
+        self._requested = True
+
+    def installSignalHandler(self):
+        signal.signal(signal.SIGHUP, self.request)
+
+    # Returns True, if a reload was requested or the files changed
+    def pending(self) -> bool:
+        if self._watch:
+            try:
+                mtimes = self._readMtimes()
+            except OSError as e:
+                logger.error(f'Failed to watch configuration: {e}')
+                return self._requested
+
+            if mtimes != self._mtimes:
+                logger.info('Configuration files changed')
+                self._mtimes = mtimes
+                self._requested = True
+
+        return self._requested
+
+    # Reloads the configuration. Returns the names of endpoints that were
+    # (re)built and need to be connected.
+    def reload(self) -> list:
+        self._requested = False
+        logger.info('Reloading configuration')
+
+        try:
+            endpoint_cfg, trigger_cfg, action_cfg = config.load(self._path)
+
+            endpoints = {}
+            built = []
+            for k in sorted(endpoint_cfg, key=lambda k: config.needs_context(endpoint_cfg[k])):
+                unchanged = k in self._endpoints and endpoint_cfg[k] == self._endpoint_cfg.get(k)
+                # Fleets hold references to other endpoints
+                if config.needs_context(endpoint_cfg[k]) and built:
+                    unchanged = False
+
+                if unchanged:
+                    endpoints[k] = self._endpoints[k]
+                else:
+                    endpoints[k] = config.build_endpoint(k, endpoint_cfg[k], endpoints)
+                    built.append(k)
+
+            triggers = config.build_triggers(trigger_cfg, endpoints)
+        except Exception as e:
+            logger.error(f'Failed to reload configuration, keeping the running one: {e}')
+            return []
+
+        try:
+            actions = config.build_actions(action_cfg, endpoints, triggers)
+        except Exception as e:
+            logger.error(f'Failed to reload configuration, keeping the running one: {e}')
+            for k in triggers:
+                triggers[k].close()
+
+            return []
+
+        # Carry over the runtime state of unchanged actions
+        kept = [k for k in actions if k in self._actions and action_cfg[k] == self._action_cfg.get(k)]
+        for k in kept:
+            actions[k].loadSnapshot(self._actions[k].dumpSnapshot())
+
+        for k in triggers:
+            if k in self._triggers and trigger_cfg[k] == self._trigger_cfg.get(k):
+                old = self._triggers[k].dumpSnapshot()
+                triggers[k].loadSnapshot({a: old[a] for a in old if a in kept})
+
+        for k in self._triggers:
+            self._triggers[k].close()
+
+        for k in self._endpoints:
+            if endpoints.get(k) is not self._endpoints[k]:
+                logger.debug(f'Disconnecting endpoint "{k}"')
+                self._endpoints[k].disconnectTransport()
+
+        for current, new in [(self._endpoints, endpoints), (self._triggers, triggers), (self._actions, actions)]:
+            current.clear()
+            current.update(new)
+
+        self._endpoint_cfg, self._trigger_cfg, self._action_cfg = endpoint_cfg, trigger_cfg, action_cfg
+
+        logger.info(f'Reloaded configuration. Rebuilt endpoints: {built}')
+        return built
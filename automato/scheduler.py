@@ -0,0 +1,104 @@
+from typing import Dict
+from concurrent.futures import ThreadPoolExecutor, wait
+import asyncio
+import heapq
+import logging
+import time
+
+from automato import action
+
+logger = logging.getLogger(__name__)
+
+'''
+Scheduler keeps all actions in a priority queue, ordered by the time their
+triggers are due next. Each run only executes actions which are due, and
+returns the time of the next deadline, so the caller can sleep until exactly
+then.
+
+Due actions are run concurrently on a pool of worker threads, or on the
+event loop with arun(). A slow endpoint only blocks the worker evaluating it,
+so one run takes about as long as the slowest action instead of the sum of
+all of them. How many workers may access a single endpoint at once is
+limited by the endpoints' `concurrency` setting.
+
+Actions that do not report a next run time are re-run after `looptime`.
+No action is re-run within `min_looptime`, even if its triggers are due
+earlier, eg. with `interval: 0`.
+'''
+class Scheduler:
+    def __init__(self, actions: Dict[str, action.Action], workers: int = 8, looptime: float = 60, min_looptime: float = 1):
+        self._actions = actions
+        self._workers = workers
+        self._looptime = looptime
+        self._min_looptime = min_looptime
+        self._executor = None
+
+        self._queue = [(0, k) for k in actions]
+        heapq.heapify(self._queue)
+
+    # Re-reads the actions, eg. after a reload. All of them are due immediately.
+    def reset(self):
+        self._queue = [(0, k) for k in self._actions]
+        heapq.heapify(self._queue)
+
+    def _popDue(self) -> list:
+        now = time.time()
+        due = []
+
+        while self._queue and self._queue[0][0] <= now:
+            due.append(heapq.heappop(self._queue)[1])
+
+        return due
+
+    def _requeue(self, keys: list):
+        now = time.time()
+        for k in keys:
+            next_run = self._actions[k].nextRun()
+            if next_run is None:
+                next_run = now + self._looptime
+
+            heapq.heappush(self._queue, (max(next_run, now + self._min_looptime), k))
+
+    # Time of the next deadline
+    def nextRun(self) -> float:
+        if not self._queue:
+            return time.time() + self._looptime
+
+        return min(self._queue[0][0], time.time() + self._looptime)
+
+    # Executes all due actions and waits for them to finish.
+    # returns the time of the next deadline
+    def run(self) -> float:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='automato-worker')
+            logger.debug(f'Scheduler started with {self._workers} workers')
+
+        due = self._popDue()
+        futures = {self._executor.submit(self._actions[k].execute): k for k in due}
+        wait(futures)
+
+        self._requeue(due)
+
+        # A failing action must not stop the others, eg. while an endpoint is down
+        for f in futures:
+            if f.exception() is not None:
+                logger.error(f'Action "{futures[f]}" failed: {f.exception()}')
+
+        return self.nextRun()
+
+    async def arun(self) -> float:
+        due = self._popDue()
+        try:
+            results = await asyncio.gather(*[self._actions[k].aexecute() for k in due], return_exceptions=True)
+        finally:
+            self._requeue(due)
+
+        for k, r in zip(due, results):
+            if isinstance(r, Exception):
+                logger.error(f'Action "{k}" failed: {r}')
+
+        return self.nextRun()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
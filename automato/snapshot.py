@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+'''
+Snapshots of the runtime state, used for warm restarts.
+
+A snapshot contains the collected data of all states, the last results of
+all trigger instances and the last run of all actions. It is saved
+periodically and restored at startup, so states still inside their TTL
+are not collected again and actions keep their cooldown and repeat history.
+
+Implementations of SnapshotBackend:
+
+MUST implement:
+  save(self, snapshot: dict)
+    snapshot only contains JSON serializable values
+  load(self) -> dict
+    returns an empty dict if no snapshot exists
+
+SHOULDNT implement:
+  __init__(self, path: str)
+'''
+class SnapshotBackend:
+    def __init__(self, path: str):
+        self._path = path
+        self._init()
+
+    def _init(self):
+        pass
+
+    def save(self, snapshot: dict):
+        raise NotImplemented
+
+    def load(self) -> dict:
+        raise NotImplemented
+
+'''
+FileBackend stores the snapshot as a JSON file. The file is replaced
+atomically, so a crash while saving leaves the previous snapshot intact.
+'''
+class FileBackend(SnapshotBackend):
+    def save(self, snapshot: dict):
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, self._path)
+
+    def load(self) -> dict:
+        if not os.path.exists(self._path):
+            return {}
+
+        with open(self._path, 'r') as f:
+            return json.load(f)
+
+class SqliteBackend(SnapshotBackend):
+    def _init(self):
+        with sqlite3.connect(self._path) as db:
+            db.execute('CREATE TABLE IF NOT EXISTS snapshot (section TEXT PRIMARY KEY, data TEXT)')
+
+    def save(self, snapshot: dict):
+        with sqlite3.connect(self._path) as db:
+            db.executemany('INSERT OR REPLACE INTO snapshot (section, data) VALUES (?, ?)',
+                           [(k, json.dumps(v)) for k, v in snapshot.items()])
+
+    def load(self) -> dict:
+        with sqlite3.connect(self._path) as db:
+            return {k: json.loads(v) for k, v in db.execute('SELECT section, data FROM snapshot')}
+
+class Snapshot:
+    def __init__(self, backend: SnapshotBackend, endpoints: dict, triggers: dict, actions: dict,
+                 interval: float = 60):
+        self._backend = backend
+        self._endpoints = endpoints
+        self._triggers = triggers
+        self._actions = actions
+        self._interval = interval
+        self._last_save = time.time()
+
+    def save(self):
+        start = time.time()
+        self._backend.save({
+            'endpoints': {k: self._endpoints[k].dumpSnapshot() for k in self._endpoints},
+            'triggers': {k: self._triggers[k].dumpSnapshot() for k in self._triggers},
+            'actions': {k: self._actions[k].dumpSnapshot() for k in self._actions},
+        })
+
+        self._last_save = time.time()
+        logger.debug(f'Saved snapshot in {self._last_save - start:.2f}s')
+
+    # Saves the snapshot, if the last one is older than the interval
+    def checkpoint(self):
+        if time.time() - self._last_save >= self._interval:
+            self.save()
+
+    def restore(self):
+        try:
+            snapshot = self._backend.load()
+        except Exception as e:
+            logger.error(f'Failed to load snapshot, starting without: {e}')
+            return
+
+        for section, objects in [('endpoints', self._endpoints), ('triggers', self._triggers), ('actions', self._actions)]:
+            for k, data in snapshot.get(section, {}).items():
+                if k not in objects:
+                    logger.debug(f'Ignoring snapshot of removed "{k}"')
+                    continue
+
+                objects[k].loadSnapshot(data)
+
+        logger.info('Restored snapshot')
@@ -1,8 +1,17 @@
+from array import array
+import asyncio
+import contextlib
+import copy
+import random
+import threading
 import time
 import logging
 logger = logging.getLogger(__name__)
 
 from automato import transport
+from automato import aio
+from automato import metrics
+from automato.state.history import History
 
 '''
 Implementations of State:
@@ -13,11 +22,33 @@ MUST implement:
 CAN implement:
   _init(self, [transport], <other options you might need>)
   _get(self, key: str)
+  _acollect(self)
+    async counterpart of _collect(). By default, _collect() is run in the
+    blocking call pool.
+  _changed(self, old) -> [None,set]
+    returns the keys changed compared to the copy 'old' of self._data,
+    None if unknown. Needed if self._data is not a dictionary.
+  toDict(self) -> dict
+    returns all keys and values. Needed if self._data is not a dictionary.
+  collectFrom(self, transport) -> [None,dict]
+    collects from the given transport and returns toDict(), None on
+    failure. Needed to use the state in a fleet, see automato.fleet.
+    Instances used for this are not used otherwise, so self._data can be
+    overwritten.
 
 SHOULDNT implement:
   get(self, key)
   collect(self)
-  __init__(self, endpoint_info: dict, ttl: int = 30, **kwargs)
+  refresh(self)
+  aget(self, key), acollect(self), arefresh(self)
+  addListener(self, listener), removeListener(self, listener)
+  setName(self, endpoint: str, name: str)
+  dumpSnapshot(self) -> dict, loadSnapshot(self, snapshot: dict)
+  stagger(self)
+  history(self, key: str) -> History
+  claimCollection(self) -> bool, releaseCollection(self)
+  aclaimCollection(self) -> bool, areleaseCollection(self)
+  __init__(self, endpoint_info: dict, ttl: int = 30, history: int = 10, grace: float = 0, **kwargs)
 
 Data is stored in self._data as a dictionary.
 By default, _get(key) retrieves the returns self._data[key].
@@ -26,18 +57,41 @@ This behaviour can be overridden by implementing a own _get().
 If using the default _get(), _collect() has to store data in
 the self._data dictionary. If an own _get() is implemented,
 this does not need to be the case.
+
+Listeners added with addListener() are called with the set of changed keys
+whenever a collection changed self._data. If self._data is not a dictionary,
+they are called with None.
+
+history(key) starts recording the numeric value of key after every
+collection, keeping the last `history` samples. Keys with a history are
+reported as changed on every collection, as their aggregates change.
+
+Collections are single-flight: if the TTL expired, only one reader collects
+and concurrent readers wait for its result. Within `grace` seconds after the
+TTL expired, they get the previous data instead of waiting.
 '''
 class State:
     # TODO set default TTL in child classes
-    def __init__(self, endpoint_info: dict, ttl: int = 30, **kwargs):
+    def __init__(self, endpoint_info: dict, ttl: int = 30, history: int = 10, grace: float = 0, **kwargs):
         self._ttl = ttl
+        self._grace = grace
         self._endpoint_info = endpoint_info
+        self._history_size = history
 
         self._data = {}
         self._last_collected = 0
+        self._listeners = []
+        self._history = {}
+        self._collect_lock = threading.Lock()
+        self._acollect_lock = None
+        self._labels = {'endpoint': '', 'state': ''}
 
         self._init(**kwargs)
 
+    # Names are only used to label metrics
+    def setName(self, endpoint: str, name: str):
+        self._labels = {'endpoint': endpoint, 'state': name}
+
     def _init(self):
         pass
 
@@ -51,27 +105,275 @@ class State:
 
         return self._data[key]
 
+    def toDict(self) -> dict:
+        return dict(self._data) if isinstance(self._data, dict) else {}
+
+    # Counterpart of toDict(), for data collected elsewhere
+    def loadDict(self, data: dict):
+        self._data = dict(data)
+
+    def collectFrom(self, transport) -> [None,dict]:
+        raise NotImplemented
+
     def _shouldCollect(self):
         return time.time() - self._last_collected > self._ttl
 
+    # _shouldCollect(), counting cache hits. Misses are counted by _collectOnce()
+    def _cacheMiss(self) -> bool:
+        miss = self._shouldCollect()
+        if not miss:
+            metrics.STATE_CACHE.inc(result='hit', **self._labels)
+        return miss
+
+    def _isStale(self) -> bool:
+        return self._last_collected > 0 and time.time() - self._last_collected <= self._ttl + self._grace
+
+    # Used by Endpoint to collect this state in a batch. Returns False if
+    # another collection is in flight.
+    def claimCollection(self) -> bool:
+        return self._collect_lock.acquire(blocking=False)
+
+    def releaseCollection(self):
+        self._collect_lock.release()
+
+    def _asyncCollectLock(self):
+        if self._acollect_lock is None:
+            self._acollect_lock = asyncio.Lock()
+
+        return self._acollect_lock
+
+    async def aclaimCollection(self) -> bool:
+        lock = self._asyncCollectLock()
+        if lock.locked():
+            return False
+
+        return await lock.acquire()
+
+    async def areleaseCollection(self):
+        self._asyncCollectLock().release()
+
+    # Single-flight collection of an expired state
+    def _collectOnce(self):
+        if not self._collect_lock.acquire(blocking=False):
+            if self._isStale():
+                metrics.STATE_CACHE.inc(result='stale', **self._labels)
+                return
+
+            self._collect_lock.acquire()
+
+        try:
+            if not self._shouldCollect():
+                metrics.STATE_CACHE.inc(result='coalesced', **self._labels)
+                return
+
+            metrics.STATE_CACHE.inc(result='miss', **self._labels)
+            self.collect()
+        finally:
+            self._collect_lock.release()
+
+    async def _acollectOnce(self):
+        lock = self._asyncCollectLock()
+        if lock.locked() and self._isStale():
+            metrics.STATE_CACHE.inc(result='stale', **self._labels)
+            return
+
+        async with lock:
+            if not self._shouldCollect():
+                metrics.STATE_CACHE.inc(result='coalesced', **self._labels)
+                return
+
+            metrics.STATE_CACHE.inc(result='miss', **self._labels)
+            await self.acollect()
+
     def get(self, key: str):
-        if self._shouldCollect():
+        if self._cacheMiss():
             logger.debug(f'Cached value for "{key}" is too old. refreshing.')
-            self.collect()
+            self._collectOnce()
         else:
             logger.debug(f'Using cached value for "{key}".')
 
 
         return self._get(key)
 
+    # Reads key without checking the TTL, eg. right after a batched collection
+    def peek(self, key: str):
+        return self._get(key)
+
+    def dumpSnapshot(self) -> dict:
+        return {'data': self._data, 'last_collected': self._last_collected}
+
+    def loadSnapshot(self, snapshot: dict):
+        self._data = snapshot['data']
+        self._last_collected = snapshot['last_collected']
+
+    # Expires the state at a random point within its TTL. States without
+    # data are still collected on first use.
+    def stagger(self):
+        self._last_collected = min(self._last_collected, time.time() - random.uniform(0, self._ttl))
+
+    def addListener(self, listener):
+        self._listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def history(self, key: str) -> History:
+        if key not in self._history:
+            self._history[key] = History(self._history_size)
+
+        return self._history[key]
+
+    def _record(self):
+        for key, history in self._history.items():
+            value = self._get(key)
+            if isinstance(value, (int, float)):
+                history.append(value, self._last_collected)
+
+    def _snapshot(self):
+        return copy.copy(self._data) if self._listeners else None
+
+    def _changed(self, old) -> [None,set]:
+        if isinstance(old, dict) and isinstance(self._data, dict):
+            return {k for k in old.keys() | self._data.keys() if old.get(k) != self._data.get(k)}
+
+        return set() if old == self._data else None
+
+    def _notify(self, old):
+        if not self._listeners:
+            return
+
+        changed = self._changed(old)
+        if changed is not None and self._history:
+            changed |= self._history.keys()
+
+        if changed is not None and not changed:
+            return
+
+        logger.debug(f'State changed: {changed}')
+        for listener in self._listeners:
+            listener(changed)
+
+    # Bookkeeping after every collection. 'old' is the result of _snapshot()
+    def _collected(self, old):
+        self._last_collected = time.time()
+        self._record()
+        self._notify(old)
+
+    # Collects if the TTL expired
+    def refresh(self):
+        if self._cacheMiss():
+            self._collectOnce()
+
     # Force datacollection. not really needed
     def collect(self):
-        self._collect()
-        self._last_collected = time.time()
+        self._collectWith(self._collect)
+
+    # Runs collect() with the bookkeeping of every collection. 'elapsed' is
+    # time already spent on it, eg. running its command in a batch.
+    def _collectWith(self, collect, elapsed: float = 0):
+        old = self._snapshot()
+        start = time.perf_counter()
+        try:
+            collect()
+        finally:
+            metrics.STATE_COLLECT.observe(elapsed + time.perf_counter() - start, **self._labels)
+        self._collected(old)
+
+    async def _acollect(self):
+        await aio.run_blocking(self._collect)
+
+    async def aget(self, key: str):
+        if self._cacheMiss():
+            logger.debug(f'Cached value for "{key}" is too old. refreshing.')
+            await self._acollectOnce()
+        else:
+            logger.debug(f'Using cached value for "{key}".')
+
+        return self._get(key)
+
+    async def arefresh(self):
+        if self._cacheMiss():
+            await self._acollectOnce()
+
+    async def acollect(self):
+        old = self._snapshot()
+        with metrics.STATE_COLLECT.time(**self._labels):
+            await self._acollect()
+        self._collected(old)
 
-class UserSessionState(State):
-    def _init(self, transport: transport.SshTransport):
+'''
+CommandState is the base for states, which run a single shell command on an
+SshTransport and parse its output.
+
+The output is streamed line by line while the command runs, with at most
+`max_bytes` bytes within `timeout` seconds. Otherwise the collection fails
+and the previous values are kept.
+
+Implementations MUST set:
+  COMMAND
+    the shell command to run
+
+MUST implement one of:
+  _parseLines(self, lines)
+    processes the decoded output lines of COMMAND, while they arrive, and
+    stores the result in self._data. Results MUST only be stored after the
+    last line, as the command can still fail after its output.
+    It can stop reading early, the command is then aborted.
+  _parse(self, output: str)
+    processes the complete decoded output of COMMAND
+
+Running the command and parsing its output are separated, so multiple states
+using the same transport can be collected in one batch by their Endpoint.
+'''
+class CommandState(State):
+    COMMAND = None
+
+    def _init(self, transport: transport.SshTransport, max_bytes: int = 1048576, timeout: float = 5):
         self._transport = transport
+        self._max_bytes = max_bytes
+        self._timeout = timeout
+
+    def _parse(self, output: str):
+        raise NotImplemented
+
+    def _parseLines(self, lines):
+        self._parse('\n'.join(lines))
+
+    def _lines(self, transport):
+        if not hasattr(transport, 'execStream'):
+            yield from transport.execHandleStderror(self.COMMAND).decode('utf-8').splitlines()
+            return
+
+        with contextlib.closing(transport.execStream(self.COMMAND, max_bytes=self._max_bytes, timeout=self._timeout)) as stream:
+            for line in stream:
+                yield line.decode('utf-8')
+
+    def _stream(self, transport):
+        with contextlib.closing(self._lines(transport)) as lines:
+            self._parseLines(lines)
+
+    def _collect(self):
+        self._stream(self._transport)
+
+    def getTransport(self):
+        return self._transport
+
+    def collectFrom(self, transport: transport.SshTransport) -> [None,dict]:
+        self._stream(transport)
+        return self.toDict()
+
+    def isDue(self) -> bool:
+        return self._shouldCollect()
+
+    # Used to pass the output of a batched collection. 'elapsed' is the
+    # share of this state in the time the batch took.
+    def collectOutput(self, output: bytes, elapsed: float = 0):
+        metrics.STATE_CACHE.inc(result='miss', **self._labels)
+        self._collectWith(lambda: self._parseLines(output.decode('utf-8').splitlines()), elapsed)
+
+class UserSessionState(CommandState):
+    COMMAND = 'who'
 
     def _get(self, key: str):
         if key not in self._data:
@@ -79,52 +381,135 @@ class UserSessionState(State):
 
         return self._data[key]
 
-    def _collect(self):
-        data = self._transport.execHandleStderror('who').decode('utf-8')
-        # TODO error handling
-        lines = data.split('\n')
-
-        self._data = {}
+    def _parseLines(self, lines):
+        data = {}
 
         for l in lines:
-            name, _ = l.split(' ', 1)
+            if not l.strip():
+                continue
+
+            name = l.split(' ', 1)[0]
 
             logger.debug(f'Found user session {name}')
 
-            if name not in self._data:
-                self._data[name] = 0
+            if name not in data:
+                data[name] = 0
 
-            self._data[name] += 1
+            data[name] += 1
 
-class LinuxMemoryState(State):
-    def _init(self, transport: transport.SshTransport):
-        self._transport = transport
+        self._data = data
 
-    def _collect(self):
-        mem_data = self._transport.execHandleStderror('cat /proc/meminfo').decode('utf-8')
+# Index maps shared by all ArrayStates with the same keys. keys -> (keys, index)
+_layouts = {}
 
-        # TODO We prbly don't wan't raw values. Process them!
-        self._data['mem'] = {}
-        for l in mem_data.splitlines():
-            arr = l.split()
-            key = arr[0].strip(':')
-            val = arr[1]
+'''
+ArrayState stores numeric values in a fixed-field array instead of a dictionary.
+Keys are mapped to positions by an index map, which is shared by all states
+with the same keys. Values are parsed once, when collected.
+
+Implementations MUST set:
+  TYPECODE
+    typecode of the array, see the array module
+  KEYS
+    tuple of keys, if they are known in advance. Otherwise
+    _setLayout() has to be called by _parse().
+'''
+class ArrayState(CommandState):
+    TYPECODE = 'd'
+    KEYS = ()
 
-            self._data['mem'][key] = val
+    def _init(self, transport: transport.SshTransport, **kwargs):
+        super()._init(transport, **kwargs)
+        self._setLayout(tuple(self.KEYS))
 
-            logger.debug(f'Memory: {key} = {val}')
+    def _setLayout(self, keys: tuple):
+        if keys not in _layouts:
+            _layouts[keys] = (keys, {k: i for i, k in enumerate(keys)})
 
-class LinuxLoadState(State):
-    def _init(self, transport: transport.SshTransport):
-        self._transport = transport
+        self._keys, self._index = _layouts[keys]
+        self._data = array(self.TYPECODE, [0] * len(keys))
 
-    def _collect(self):
-        load_raw = self._transport.execHandleStderror('cat /proc/loadavg').decode('utf-8')
+    def _get(self, key: str):
+        if key not in self._index:
+            logger.error(f'Data key {key} was not found.')
+            return None
 
-        data = load_raw.split(None,4)
+        return self._data[self._index[key]]
 
-        self._data = {}
+    def toDict(self) -> dict:
+        return dict(zip(self._keys, self._data))
+
+    def loadDict(self, data: dict):
+        self._setLayout(tuple(data.keys()))
+        self._data = array(self.TYPECODE, list(data.values()))
+
+    def _changed(self, old) -> [None,set]:
+        if len(old) != len(self._data):
+            return None
+
+        return {self._keys[i] for i in range(len(old)) if old[i] != self._data[i]}
+
+    def dumpSnapshot(self) -> dict:
+        return {'keys': list(self._keys), 'data': list(self._data), 'last_collected': self._last_collected}
+
+    def loadSnapshot(self, snapshot: dict):
+        if 'keys' not in snapshot:
+            logger.debug('Ignoring snapshot in old format')
+            return
+
+        self._setLayout(tuple(snapshot['keys']))
+        self._data = array(self.TYPECODE, snapshot['data'])
+        self._last_collected = snapshot['last_collected']
+
+'''
+LinuxMemoryState provides the values of /proc/meminfo as integers, in kB
+where /proc/meminfo uses kB. Keys are the field names, eg. MemAvailable.
+'''
+class LinuxMemoryState(ArrayState):
+    COMMAND = 'cat /proc/meminfo'
+    TYPECODE = 'q'
+
+    def _get(self, key: str):
+        # Values used to be stored as a dictionary under 'mem'
+        if key == 'mem':
+            return self.toDict()
+        if key.startswith('mem.'):
+            key = key[4:]
+
+        return super()._get(key)
+
+    def _changed(self, old) -> [None,set]:
+        changed = super()._changed(old)
+        if changed:
+            changed.add('mem')
+
+        return changed
+
+    def _parseLines(self, lines):
+        keys = []
+        values = []
+        for l in lines:
+            arr = l.split()
+            if not arr:
+                continue
+            keys.append(arr[0].rstrip(':'))
+            values.append(int(arr[1]))
+
+        # The fields only change with the kernel, so the layout is usually reused
+        keys = tuple(keys)
+        if keys != self._keys:
+            self._setLayout(keys)
+
+        self._data = array(self.TYPECODE, values)
+
+class LinuxLoadState(ArrayState):
+    COMMAND = 'cat /proc/loadavg'
+    KEYS = ('1', '5', '15')
+
+    # Only the first line is read
+    def _parseLines(self, lines):
+        data = next(iter(lines), '').split(None,4)
+        if len(data) < 3:
+            raise Exception(f'Unexpected load average "{" ".join(data)}"')
 
-        self._data['1'] = data[0]
-        self._data['5'] = data[1]
-        self._data['15'] = data[2]
+        self._data = array(self.TYPECODE, [float(data[0]), float(data[1]), float(data[2])])
@@ -0,0 +1,90 @@
+from array import array
+import collections
+import operator
+
+'''
+History keeps the last `size` samples of a state key in a ring buffer.
+
+Samples are stored with their timestamps in preallocated arrays, appending
+is O(1). The aggregates over the buffer are maintained while appending,
+so reading them does not scan the samples:
+  - the sum for avg() is updated by the added and the evicted sample. It is
+    recomputed once per wrap of the buffer to not accumulate rounding errors.
+  - min() and max() use monotonic queues of (sequence, value).
+  - delta() and rate() only need the oldest and newest sample.
+
+All aggregates return None as long as there are no samples.
+'''
+class History:
+    def __init__(self, size: int):
+        self._size = max(1, int(size))
+        self._values = array('d', [0] * self._size)
+        self._times = array('d', [0] * self._size)
+        self._count = 0
+        self._sum = 0
+        self._min = collections.deque()
+        self._max = collections.deque()
+
+    def __len__(self):
+        return min(self._count, self._size)
+
+    def append(self, value: float, timestamp: float):
+        i = self._count % self._size
+        if self._count >= self._size:
+            self._sum -= self._values[i]
+
+        self._values[i] = value
+        self._times[i] = timestamp
+        self._sum += value
+
+        seq = self._count
+        self._count += 1
+        if i == self._size - 1:
+            self._sum = sum(self._values)
+
+        oldest = self._count - len(self)
+        for queue, dominates in [(self._min, operator.le), (self._max, operator.ge)]:
+            while queue and dominates(value, queue[-1][1]):
+                queue.pop()
+            queue.append((seq, value))
+
+            while queue[0][0] < oldest:
+                queue.popleft()
+
+    def _first(self) -> int:
+        return (self._count - len(self)) % self._size
+
+    def _last(self) -> int:
+        return (self._count - 1) % self._size
+
+    def avg(self):
+        if not self._count:
+            return None
+
+        return self._sum / len(self)
+
+    def min(self):
+        return self._min[0][1] if self._count else None
+
+    def max(self):
+        return self._max[0][1] if self._count else None
+
+    # Difference between the newest and the oldest sample
+    def delta(self):
+        if not self._count:
+            return None
+
+        return self._values[self._last()] - self._values[self._first()]
+
+    # Change per second between the oldest and the newest sample
+    def rate(self):
+        if not self._count:
+            return None
+
+        elapsed = self._times[self._last()] - self._times[self._first()]
+        if elapsed <= 0:
+            return 0
+
+        return self.delta() / elapsed
+
+AGGREGATES = ['avg', 'min', 'max', 'rate', 'delta']
@@ -1,25 +1,106 @@
+import codecs
 import logging
 
 from automato.transport.http import HttpTransport
 from automato.state import State
+from automato.state.jsonpath import Selector
 
 logger = logging.getLogger(__name__)
 
+'''
+HttpJsonState
 
+REQUIRED ARGUMENTS
+    method: HTTP method
+    path: Path of the request
+OPTIONAL ARGUMENTS
+    json_path: Select values from the response instead of storing all of it.
+        A single path, eg. `$.status`, stores the selected object. A selected
+        value, which is not an object, is stored under the key `value`.
+        A list of paths or a dict of names and paths stores a dict of the
+        selected values, by path or name.
+    chunk_size: Size of the chunks the response is read in, if json_path is set
+    conditional: Revalidate with the ETag and Last-Modified of the last response,
+        so an unchanged document is neither downloaded nor decoded again
+    Any other arguments are passed to HttpTransport.request()
+
+If json_path is set, the response is parsed while it is streamed and only the
+selected values are kept. Paths which are not found are set to None.
+
+If the server answers a conditional request with 304 Not Modified, the
+collected data is kept.
+'''
 class HttpJsonState(State):
     def _init(self, transport: HttpTransport, method: str, path: str,
-              json_path: [None,str] = None, **kwargs):
-
-        if json_path is not None:
-            logger.warning('Filtering of JSON path requested but not implemented')
+              json_path: [None,str,list,dict] = None, chunk_size: int = 65536,
+              conditional: bool = True, **kwargs):
 
         self._transport = transport
         self._path = path
         self._method = method
         self._json_path = json_path
+        self._chunk_size = chunk_size
         self._request_args = kwargs
+        self._conditional = conditional
+        self._validators = None
+
+        self._selector = None
+        if isinstance(json_path, str):
+            self._selector = Selector({json_path: json_path})
+        elif isinstance(json_path, list):
+            self._selector = Selector({p: p for p in json_path})
+        elif isinstance(json_path, dict):
+            self._selector = Selector(json_path)
+
+    # returns None if the document was not modified
+    def _request(self, transport: HttpTransport, validators: [None,dict]):
+        response = transport.request(self._method, self._path, validators=validators,
+                                     stream=self._selector is not None, **self._request_args)
+        if response is None:
+            raise Exception(f'Request {self._method} {self._path} failed')
+
+        if response.status_code == 304:
+            logger.debug(f'{self._path} was not modified')
+            response.close()
+            return None
+
+        return response
+
+    # Decodes the response, or only the selected values of it
+    def _read(self, response):
+        if self._selector is None:
+            return response.json()
+
+        with response:
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            selected = self._selector.select(decoder.decode(c) for c in response.iter_content(self._chunk_size))
+
+        for name in self._selector.names():
+            if name not in selected:
+                logger.warning(f'JSON path "{name}" was not found in response of {self._path}')
+                selected[name] = None
+
+        if not isinstance(self._json_path, str):
+            return selected
+
+        value = selected[self._json_path]
+        return value if isinstance(value, dict) else {'value': value}
 
     def _collect(self):
-        response = self._transport.request(self._method, self._path,
-                                           **self._request_args)
-        self._data = response.json()
+        response = self._request(self._transport, self._validators)
+        if response is None:
+            return
+
+        # The validators are only kept together with the data they belong to
+        data = self._read(response)
+        self._validators = HttpTransport.validators(response) if self._conditional and response.ok else None
+        self._data = data
+
+    # Requests of fleets are not conditional
+    def collectFrom(self, transport: HttpTransport) -> [None,dict]:
+        response = self._request(transport, None)
+        if response is None:
+            return None
+
+        data = self._read(response)
+        return data if isinstance(data, dict) else {}
@@ -0,0 +1,223 @@
+import json
+import re
+
+'''
+JSON path selectors
+
+Paths select a single value from a JSON document, eg. `$.status.health`,
+`items[0].name` or `['key.with.dots']`. A leading `$` is optional.
+
+A Selector compiles multiple named paths into a tree once. select() reads
+the document as a stream of text chunks and only decodes the selected
+values, everything else is skipped without building any objects. Reading
+stops as soon as all paths were found.
+'''
+
+_SEGMENT = re.compile(r'''\.?([^.\[\]'"]+)|\[(\d+)\]|\['([^']*)'\]|\["([^"]*)"\]''')
+
+_WHITESPACE = re.compile(r'\s*')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+_SCALAR = re.compile(r'[^\s,\]}]+')
+# Anything inside a container, that is neither a string nor a bracket
+_OTHER = re.compile(r'[^"{}\[\]]+')
+
+# Key of the selected names in a node of the selector tree
+_NAMES = None
+
+def compile_path(path: str) -> tuple:
+    path = path.strip()
+    if path.startswith('$'):
+        path = path[1:]
+
+    keys = []
+    pos = 0
+    while pos < len(path):
+        m = _SEGMENT.match(path, pos)
+        if m is None:
+            raise ValueError(f'Invalid JSON path "{path}" at {pos}')
+
+        key, index, single, double = m.groups()
+        if index is not None:
+            keys.append(int(index))
+        else:
+            keys.append(key if key is not None else single if single is not None else double)
+        pos = m.end()
+
+    return tuple(keys)
+
+class Selector:
+    def __init__(self, paths: dict):
+        self._tree = {}
+        self._names = list(paths.keys())
+
+        for name, path in paths.items():
+            node = self._tree
+            for key in compile_path(path):
+                node = node.setdefault(key, {})
+            node.setdefault(_NAMES, []).append(name)
+
+    def names(self) -> list:
+        return self._names
+
+    # Selects from a decoded document
+    def selectObject(self, document) -> dict:
+        result = {}
+        _resolve(self._tree, document, result)
+        return result
+
+    # Selects from an iterable of text chunks
+    def select(self, chunks) -> dict:
+        result = {}
+        _Scanner(chunks, len(self._names), result).select(self._tree)
+        return result
+
+def _resolve(node: dict, value, result: dict):
+    for name in node.get(_NAMES, []):
+        result[name] = value
+
+    for key, child in node.items():
+        if key is _NAMES:
+            continue
+
+        if isinstance(value, dict) and isinstance(key, str) and key in value:
+            _resolve(child, value[key], result)
+        elif isinstance(value, list) and isinstance(key, int) and key < len(value):
+            _resolve(child, value[key], result)
+
+class _Scanner:
+    def __init__(self, chunks, remaining: int, result: dict):
+        self._chunks = iter(chunks)
+        self._buf = ''
+        self._pos = 0
+        self._remaining = remaining
+        self._result = result
+
+    def _more(self) -> bool:
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    # Consumes a match of regex. A match running up to the end of the
+    # buffer might continue in the next chunk.
+    def _match(self, regex) -> str:
+        while True:
+            m = regex.match(self._buf, self._pos)
+            if m is not None and m.end() < len(self._buf):
+                break
+            if not self._more():
+                if m is None:
+                    raise ValueError(f'Invalid JSON at "{self._buf[self._pos:self._pos+20]}"')
+                break
+
+        self._pos = m.end()
+        return m.group()
+
+    def _peek(self) -> str:
+        self._match(_WHITESPACE)
+        return self._buf[self._pos] if self._pos < len(self._buf) else ''
+
+    def _take(self) -> str:
+        c = self._peek()
+        self._pos += 1
+        return c
+
+    # Skips a value. Its text is appended to out, if given.
+    def _skip(self, out: [None,list] = None):
+        c = self._peek()
+        if c == '':
+            raise ValueError('Unexpected end of JSON')
+
+        if c not in '{[':
+            piece = self._match(_STRING if c == '"' else _SCALAR)
+            if out is not None:
+                out.append(piece)
+            return
+
+        depth = 0
+        while True:
+            c = self._peek()
+            # '' is in every string, so the end has to be checked first
+            if c == '':
+                raise ValueError('Unexpected end of JSON')
+            elif c == '"':
+                piece = self._match(_STRING)
+            elif c in '{[':
+                piece = self._take()
+                depth += 1
+            elif c in '}]':
+                piece = self._take()
+                depth -= 1
+            else:
+                piece = self._match(_OTHER)
+
+            if out is not None:
+                out.append(piece)
+            if depth == 0:
+                return
+
+    def _expect(self, expected: str):
+        c = self._take()
+        if c != expected:
+            raise ValueError(f'Invalid JSON, expected "{expected}" but got "{c}"')
+
+    # Selects from the value at the current position. Returns False
+    # once everything was found.
+    def select(self, node: dict) -> bool:
+        if _NAMES in node:
+            out = []
+            self._skip(out)
+            before = len(self._result)
+            _resolve(node, json.loads(''.join(out)), self._result)
+            self._remaining -= len(self._result) - before
+            return self._remaining > 0
+
+        c = self._peek()
+        if c == '{':
+            self._take()
+            if self._peek() == '}':
+                self._take()
+                return True
+
+            while True:
+                self._peek()
+                key = json.loads(self._match(_STRING))
+                self._expect(':')
+                if key in node:
+                    if not self.select(node[key]):
+                        return False
+                else:
+                    self._skip()
+
+                c = self._take()
+                if c == '}':
+                    return True
+                if c != ',':
+                    raise ValueError(f'Invalid JSON, expected "," or "}}" but got "{c}"')
+
+        if c == '[':
+            self._take()
+            if self._peek() == ']':
+                self._take()
+                return True
+
+            i = 0
+            while True:
+                if i in node:
+                    if not self.select(node[i]):
+                        return False
+                else:
+                    self._skip()
+
+                c = self._take()
+                if c == ']':
+                    return True
+                if c != ',':
+                    raise ValueError(f'Invalid JSON, expected "," or "]" but got "{c}"')
+                i += 1
+
+        self._skip()
+        return True
@@ -0,0 +1,100 @@
+import copy
+import logging
+
+from automato import misc
+from automato.transport.push import PushTransport
+from automato.state import State
+
+logger = logging.getLogger(__name__)
+
+'''
+PushState holds a state pushed by the agent running on the endpoint,
+see automato.agent. It is never collected: its data is replaced whenever
+the agent pushes a change, and listeners are notified right away.
+The ttl is not used, the agent collects with the ttl configured there.
+
+Until the agent pushed the state for the first time, all keys are None.
+
+REQUIRED ARGUMENTS
+    transport: a PushTransport
+OPTIONAL ARGUMENTS
+    state: Name of the state on the agent. Defaults to the name of this state
+    source: Class of the state on the agent, eg. automato.state.UserSessionState.
+      Keys are looked up like the source does, eg. users without a session are 0.
+      Other arguments are passed to the source.
+'''
+class PushState(State):
+    def _init(self, transport: PushTransport, state: [None,str] = None, source: [None,str] = None, **kwargs):
+        self._transport = transport
+        self._state = None
+        self._received = False
+
+        self._source = None
+        if source is not None:
+            self._source = misc.import_class(source)(self._endpoint_info, transport=None, **kwargs)
+
+        if state is not None:
+            self._subscribe(state)
+
+    def setName(self, endpoint: str, name: str):
+        super().setName(endpoint, name)
+
+        if self._state is None:
+            self._subscribe(name)
+
+    def _subscribe(self, state: str):
+        self._state = state
+        self._transport.subscribe(state, self._receive)
+
+    def _load(self, data: dict):
+        self._data = data
+        self._received = True
+
+        if self._source is not None:
+            self._source.loadDict(data)
+
+    def _receive(self, data: dict):
+        # Everything changed with the first push, even if it is empty
+        old = self._snapshot() if self._received else None
+        self._load(data)
+        self._collected(old)
+
+    # With a source, changes are reported like the source does, including
+    # its aliases, eg. `mem` of LinuxMemoryState
+    def _snapshot(self):
+        if self._source is not None and self._listeners:
+            return copy.copy(self._source._data)
+
+        return super()._snapshot()
+
+    def _changed(self, old) -> [None,set]:
+        if old is None:
+            return None
+
+        if self._source is not None:
+            return self._source._changed(old)
+
+        return super()._changed(old)
+
+    def _get(self, key: str):
+        if not self._received:
+            logger.debug(f'State "{self._state}" was not pushed yet')
+            return None
+
+        if self._source is not None:
+            return self._source._get(key)
+
+        return super()._get(key)
+
+    def loadSnapshot(self, snapshot: dict):
+        super().loadSnapshot(snapshot)
+        self._load(self._data)
+
+    def _shouldCollect(self):
+        return False
+
+    def _collect(self):
+        pass
+
+    async def _acollect(self):
+        pass
@@ -1,13 +1,41 @@
-import paramiko
 import logging
+import re
+import socket
+import threading
+import time
+import uuid
 
 from typing import Union
 
+from automato import aio
+from automato import metrics
+
 logger = logging.getLogger(__name__)
 
 HOLD = 1
 THROWAWAY = 2
 
+# Bytes read from a channel at once by execStream
+CHUNK_SIZE = 32768
+
+# Splits a stream of chunks into lines, without line endings.
+# Raises if the chunks are longer than max_bytes in total.
+def split_lines(chunks, max_bytes: [None,int] = None):
+    pending = b''
+    received = 0
+
+    for chunk in chunks:
+        received += len(chunk)
+        if max_bytes is not None and received > max_bytes:
+            raise Exception(f'Command returned more than {max_bytes} bytes')
+
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+
+    if pending:
+        yield pending
+
 '''
 Implementations of Transport:
 
@@ -33,6 +61,9 @@ MUST implement:
 CAN implement:
   _init(self, <other settings you might need>)
   isConnected(self) -> bool
+  aconnect(self), adisconnect(self), acheck(self)
+    async counterparts used by the asyncio runtime. By default, the
+    synchronous functions are run in the blocking call pool.
 
 SHOULDNT implement:
   __init__(self, endpoint_info: dict, **kwargs)
@@ -64,43 +95,146 @@ class Transport:
     def isConnected(self) -> bool:
         return self._connected
 
+    async def aconnect(self):
+        return await aio.run_blocking(self.connect)
+
+    async def adisconnect(self):
+        return await aio.run_blocking(self.disconnect)
 
+    async def acheck(self):
+        return await aio.run_blocking(self.check)
+
+
+'''
+SshTransport
+
+REQUIRED ARGUMENTS
+    hostname: Host to connect to
+OPTIONAL ARGUMENTS
+    port, username, password, id_file, allow_agent: Connection settings
+    channels: Maximum number of commands run in parallel over the connection
+    keepalive: Interval in seconds of SSH keepalive packets, 0 to disable
+    connect_timeout: Time in seconds to wait for the connection to be established
+    backoff: Initial time in seconds between reconnection attempts.
+      Doubled after every failed attempt up to max_backoff
+
+All commands are run as separate channels of a single connection.
+If the host can not be reached, including on startup, or the connection
+was lost, it is (re-)established on the next command.
+'''
 class SshTransport(Transport):
     CONNECTION=HOLD
 
-    def _init(self, hostname: str, port=22,  username='root', password = None, id_file = None, allow_agent = False):
+    def _init(self, hostname: str, port=22,  username='root', password = None, id_file = None, allow_agent = False,
+              channels: int = 4, keepalive: int = 30, connect_timeout: float = 10, backoff: float = 1, max_backoff: float = 300):
         self._hostname = hostname
         self._port = port
         self._username = username
         self._password = password
         self._id_file = id_file
         self._allow_agent = allow_agent
+        self._keepalive = keepalive
+        self._connect_timeout = connect_timeout
+
+        self._channels = threading.BoundedSemaphore(channels)
+        self._connect_lock = threading.Lock()
+
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._next_backoff = backoff
+        self._next_attempt = 0
 
         self._client = None
 
     def connect(self):
+        # imported here, so HTTP-only setups do not need to load paramiko
+        import paramiko
+
+        if self._client is not None:
+            self._client.close()
+
+        self._connected = False
         self._client = paramiko.SSHClient()
 
         # TODO known hosts
         self._client.set_missing_host_key_policy(paramiko.client.AutoAddPolicy)
+        # A host which can not be reached, resolved or authenticated to must
+        # not stop the others. _ensureConnected() retries.
         try:
-            self._client.connect(self._hostname, port=self._port, username=self._username, password=self._password, key_filename=self._id_file, allow_agent=self._allow_agent)
+            self._client.connect(self._hostname, port=self._port, username=self._username, password=self._password, key_filename=self._id_file,
+                                 allow_agent=self._allow_agent, timeout=self._connect_timeout)
+            self._client.get_transport().set_keepalive(self._keepalive)
             self._connected = True
         except paramiko.ssh_exception.NoValidConnectionsError as e:
             logger.error(f'Failed to connect to {self._hostname}: {e.errors} ')
+        except Exception as e:
+            logger.error(f'Failed to connect to {self._hostname}: {e}')
 
-
-    # return(str: stdout, str: stderr, int: retcode)
-    def exec(self, command: str):
         if not self._connected:
-            # TODO we want a bit smarted connection logic
+            self._client.close()
+            self._client = None
+
+    def isConnected(self) -> bool:
+        if not self._connected or self._client is None:
+            return False
+
+        tp = self._client.get_transport()
+        return tp is not None and tp.is_active()
+
+    # Reconnects if the connection was lost. Attempts are spaced with
+    # exponential backoff, so a down host does not block every command.
+    def _ensureConnected(self) -> bool:
+        if self.isConnected():
+            return True
+
+        with self._connect_lock:
+            if self.isConnected():
+                return True
+
+            if self._connected:
+                logger.warning(f'SSH connection to {self._hostname} was lost')
+                self._connected = False
+
+            if time.time() < self._next_attempt:
+                return False
+
+            logger.info(f'Reconnecting to {self._hostname}')
+            self.connect()
+            if self._connected:
+                self._next_backoff = self._backoff
+                return True
+
+            logger.debug(f'Next connection attempt to {self._hostname} in {self._next_backoff}s')
+            self._next_attempt = time.time() + self._next_backoff
+            self._next_backoff = min(2 * self._next_backoff, self._max_backoff)
+            return False
+
+    # returns (stdin, stdout, stderr) of command
+    def _open(self, command: str, timeout: float):
+        if not self._ensureConnected():
             logger.error('SSH not connected')
             raise Exception('Not connected')
 
-        output = self._client.exec_command(command, timeout=5)
+        return self._client.exec_command(command, timeout=timeout)
+
+    def _exec(self, command: str):
+        with self._channels, metrics.TRANSPORT_REQUEST.time(transport='ssh', host=self._hostname):
+            output = self._open(command, 5)
+
+            retcode = output[1].channel.recv_exit_status()
+            return (output[1].read().strip(), output[2].read().strip(), retcode)
 
-        retcode = output[1].channel.recv_exit_status()
-        return (output[1].read().strip(), output[2].read().strip(), retcode)
+    # return(str: stdout, str: stderr, int: retcode)
+    def exec(self, command: str):
+        import paramiko
+
+        try:
+            return self._exec(command)
+        except (paramiko.ssh_exception.SSHException, EOFError) as e:
+            # The connection might have dropped without us noticing. Retry once,
+            # _ensureConnected() only reconnects if it really did.
+            logger.warning(f'SSH command on {self._hostname} failed: {e}. Retrying.')
+            return self._exec(command)
 
     def execHandleStderror(self, command: str):
         out = self.exec(command)
@@ -114,8 +248,87 @@ class SshTransport(Transport):
     def readFile(self, path: str):
         return self.execHandleStderror(f'cat "{path}"')
 
+    # Yields the lines of stdout as they arrive, as bytes without line endings.
+    # Raises if the command runs longer than `timeout` seconds in total, writes
+    # more than `max_bytes` to stdout, or returns an error after its last line.
+    # Closing the generator early closes the channel.
+    def execStream(self, command: str, max_bytes: [None,int] = None, timeout: float = 5):
+        import paramiko
+
+        with self._channels, metrics.TRANSPORT_REQUEST.time(transport='ssh', host=self._hostname):
+            try:
+                channel = self._open(command, timeout)[1].channel
+            except (paramiko.ssh_exception.SSHException, EOFError) as e:
+                logger.warning(f'SSH command on {self._hostname} failed: {e}. Retrying.')
+                channel = self._open(command, timeout)[1].channel
+
+            try:
+                deadline = time.monotonic() + timeout
+                yield from split_lines(self._recv(channel, deadline), max_bytes)
+                self._checkExit(channel, deadline)
+            finally:
+                channel.close()
+
+    def _recv(self, channel, deadline: float):
+        while True:
+            channel.settimeout(max(deadline - time.monotonic(), 0.001))
+            try:
+                chunk = channel.recv(CHUNK_SIZE)
+            except socket.timeout:
+                raise Exception(f'Command on {self._hostname} timed out')
+
+            if not chunk:
+                return
+
+            yield chunk
+
+    def _checkExit(self, channel, deadline: float):
+        if not channel.status_event.wait(max(deadline - time.monotonic(), 0)):
+            raise Exception(f'Command on {self._hostname} timed out')
+
+        retcode = channel.recv_exit_status()
+        if retcode != 0:
+            stderr = channel.recv_stderr(CHUNK_SIZE) if channel.recv_stderr_ready() else b''
+            logger.error(f'Command returned error {retcode}: {stderr.strip()}')
+            raise Exception(f'Command returned error {retcode}: {stderr.strip()}')
+
+    # Runs multiple commands in a single exec, separated by a random delimiter.
+    # returns a list of (bytes: stdout, bytes: stderr, int: retcode), one per command.
+    # stderr can not be attributed to a single command, so every failed command
+    # gets the complete stderr.
+    def execBatch(self, commands: list):
+        delim = f'automato-{uuid.uuid4().hex}'
+        script = ''.join([f'( {c} ) </dev/null; printf "\\n{delim} %d\\n" $?; ' for c in commands])
+
+        stdout, stderr, _ = self.exec(script)
+
+        parts = re.split(f'(?:^|\n){delim} (\\d+)(?:\n|$)'.encode(), stdout)
+        if len(parts) != 2 * len(commands) + 1:
+            logger.error(f'Batch of {len(commands)} commands returned unexpected output: {stderr}')
+            raise Exception(f'Batch of {len(commands)} commands returned unexpected output')
+
+        results = []
+        for i in range(len(commands)):
+            retcode = int(parts[2*i + 1])
+            results.append((parts[2*i].strip(), stderr if retcode != 0 else b'', retcode))
+
+        return results
+
+    # paramiko is blocking, so we run it in the blocking call pool
+    async def aexec(self, command: str):
+        return await aio.run_blocking(self.exec, command)
+
+    async def aexecHandleStderror(self, command: str):
+        return await aio.run_blocking(self.execHandleStderror, command)
+
+    async def areadFile(self, path: str):
+        return await aio.run_blocking(self.readFile, path)
+
+    async def aexecBatch(self, commands: list):
+        return await aio.run_blocking(self.execBatch, commands)
+
     def disconnect(self):
-        if self._connected:
+        if self._client is not None:
             self._client.close()
 
         self._connected = False
@@ -1,10 +1,20 @@
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from automato import aio
+from automato import metrics
 from automato.transport import Transport, THROWAWAY
 
 logger = logging.getLogger(__name__)
 
+# Validator header of a response -> header to send it in a conditional request
+CONDITIONAL_HEADERS = {
+    'ETag': 'If-None-Match',
+    'Last-Modified': 'If-Modified-Since',
+}
+
 '''
 HttpTransport
 
@@ -15,6 +25,14 @@ OPTIONAL ARGUMENTS
     password: Password for HTTP basic auth
     headers: Dict for headers to add in every connection
     user_agent: Change the user agent form the default requests
+    timeout: Timeout of a request in seconds
+    pool_size: Number of connections kept open to the endpoint
+    keep_alive: Reuse connections for multiple requests
+    retries: Number of retries on connection errors and 5xx responses
+    backoff: Backoff factor in seconds between retries, doubled every retry
+
+All requests share a single requests.Session, so connections are
+kept alive and reused instead of reconnecting for every request.
 '''
 class HttpTransport(Transport):
     CONNECTION = THROWAWAY
@@ -22,7 +40,9 @@ class HttpTransport(Transport):
     def _init(self, address:str,
               user:[None,str] = None, password:[None,str] = None,
               headers:[None,dict] = None, user_agent:[None,str] = None,
-              validation_path: str = '/', timeout:int = 30):
+              validation_path: str = '/', timeout:int = 30,
+              pool_size:int = 10, keep_alive:bool = True,
+              retries:int = 0, backoff:float = 0):
         self._address = address
         self._user = user
         self._password = password
@@ -31,6 +51,22 @@ class HttpTransport(Transport):
         self._validation_path = '/'
         self._timeout = timeout
 
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        if user is not None:
+            self._session.auth = (user, password)
+        if user_agent is not None:
+            self._session.headers['User-Agent'] = user_agent
+        if not keep_alive:
+            self._session.headers['Connection'] = 'close'
+
     def check(self):
         # TODO Here we could maybe also perform a more complex login
         # with Cookies?
@@ -41,8 +77,11 @@ class HttpTransport(Transport):
         return ret.ok
 
 
+    # With stream, the body is only read when accessed. The caller has to close the response.
+    # validators of a previous response make the request conditional, see validators().
     def request(self, method:str, path:str, headers:[None,dict] = None,
-                 data = None, params:[None,str] = None):
+                 data = None, params:[None,str] = None, stream:bool = False,
+                 validators:[None,dict] = None):
         full_path = self._address.rstrip('/') + '/' + path.lstrip('/')
         logger.debug(f'requested {method} for {full_path}')
 
@@ -54,16 +93,29 @@ class HttpTransport(Transport):
             else:
                 all_headers = self._headers
 
+        if validators:
+            conditional = {CONDITIONAL_HEADERS[k]: v for k, v in validators.items() if k in CONDITIONAL_HEADERS}
+            all_headers = (all_headers or {}) | conditional
+
         # TODO maybe pass **kwargs here?
         try:
-            req = requests.request(method, full_path, headers=all_headers,
-                                   data=data, params=params, timeout=self._timeout)
+            with metrics.TRANSPORT_REQUEST.time(transport='http', host=self._address):
+                req = self._session.request(method, full_path, headers=all_headers,
+                                            data=data, params=params, timeout=self._timeout,
+                                            stream=stream)
             return req
         except requests.RequestException as e:
             logger.error(f'An exception occured in {method} for {full_path}: {e}')
             #FIXME We need better error handling
             return None
 
+    # Validators of a response, used to make the next request conditional
+    @staticmethod
+    def validators(response) -> dict:
+        return {k: response.headers[k] for k in CONDITIONAL_HEADERS if k in response.headers}
+
+    async def arequest(self, method:str, path:str, **kwargs):
+        return await aio.run_blocking(self.request, method, path, **kwargs)
 
     def get(self, **kwargs):
         return self.request('GET', **kwargs)
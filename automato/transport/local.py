@@ -0,0 +1,233 @@
+import logging
+import os
+import re
+import selectors
+import signal
+import subprocess
+import threading
+import time
+import uuid
+
+from automato import aio
+from automato import metrics
+from automato.transport import Transport, HOLD, CHUNK_SIZE, split_lines
+
+logger = logging.getLogger(__name__)
+
+# Commands which only print a single file, eg. `cat /proc/loadavg`
+_CAT = re.compile(r'''^\s*cat\s+(?:"([^"$`\\]+)"|'([^']+)'|([^\s"'$`\\;|&<>()*?~{}\[\]]+))\s*$''')
+
+# Bytes of stderr kept per command
+MAX_STDERR = 65536
+
+'''
+_Shell is a long-running /bin/sh, which runs one command at a time.
+Every command is followed by a random delimiter on stdout, carrying its
+exit status, and on stderr.
+'''
+class _Shell:
+    def __init__(self):
+        self._process = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE, start_new_session=True)
+
+    def alive(self) -> bool:
+        return self._process.poll() is None
+
+    # Kills the shell and everything it started
+    def kill(self):
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        self._process.wait()
+        for f in [self._process.stdin, self._process.stdout, self._process.stderr]:
+            f.close()
+
+    # Yields the lines of stdout, without line endings. When done, stderr
+    # and retcode are set in result.
+    def run(self, command: str, deadline: float, max_bytes: [None,int], result: dict):
+        delim = f'automato-{uuid.uuid4().hex}'
+        self._process.stdin.write(f'( {command} ) </dev/null; printf "\\n{delim} %d\\n" $?; printf "\\n{delim}\\n" >&2\n'.encode())
+        self._process.stdin.flush()
+
+        delim = delim.encode()
+        err_end = b'\n' + delim + b'\n'
+        selector = selectors.DefaultSelector()
+        selector.register(self._process.stdout, selectors.EVENT_READ)
+        selector.register(self._process.stderr, selectors.EVENT_READ)
+
+        pending = b''
+        received = 0
+        # The empty line before the delimiter is added by printf
+        empty = False
+        stderr = b''
+        retcode = None
+
+        try:
+            while retcode is None or not stderr.endswith(err_end):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception('Command timed out')
+
+                for key, _ in selector.select(remaining):
+                    chunk = os.read(key.fd, CHUNK_SIZE)
+                    if not chunk:
+                        raise Exception('Shell exited unexpectedly')
+
+                    if key.fileobj is self._process.stderr:
+                        stderr = (stderr + chunk)[-(MAX_STDERR + len(err_end)):]
+                        continue
+
+                    received += len(chunk)
+                    if max_bytes is not None and received > max_bytes:
+                        raise Exception(f'Command returned more than {max_bytes} bytes')
+
+                    lines = (pending + chunk).split(b'\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        if line.startswith(delim + b' '):
+                            retcode = int(line[len(delim) + 1:])
+                            continue
+
+                        if empty:
+                            yield b''
+                        empty = line == b''
+                        if not empty:
+                            yield line
+        finally:
+            selector.close()
+
+        result['stderr'] = stderr[:-len(err_end)].strip()
+        result['retcode'] = retcode
+
+'''
+LocalTransport runs commands on the machine automato runs on. It offers the
+interface of SshTransport used by commands and states: exec,
+execHandleStderror, execStream and readFile.
+
+Commands are run by long-running shells, which are started on first use,
+so a command does not pay for starting a process of its own. Commands
+which only print a file, like `cat /proc/loadavg` of LinuxLoadState, are
+not run at all, the file is read directly.
+
+OPTIONAL ARGUMENTS
+    timeout: Time in seconds a command may run
+    shells: Maximum number of commands run in parallel
+'''
+class LocalTransport(Transport):
+    CONNECTION = HOLD
+
+    def _init(self, timeout: float = 5, shells: int = 2):
+        self._timeout = timeout
+        self._slots = threading.BoundedSemaphore(shells)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        self._connected = True
+
+    # Stops the idle shells. Shells in use stop after their command.
+    def disconnect(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for shell in idle:
+            shell.kill()
+
+        self._connected = False
+
+    def _shell(self) -> _Shell:
+        with self._lock:
+            while self._idle:
+                shell = self._idle.pop()
+                if shell.alive():
+                    return shell
+
+                shell.kill()
+
+        return _Shell()
+
+    def _release(self, shell: _Shell):
+        with self._lock:
+            if self._connected:
+                self._idle.append(shell)
+                return
+
+        shell.kill()
+
+    # Yields the lines of stdout of a command run by a shell,
+    # see _Shell.run(). A shell is only reused after a complete run.
+    def _run(self, command: str, max_bytes: [None,int], timeout: float, result: dict):
+        with self._slots, metrics.TRANSPORT_REQUEST.time(transport='local', host='localhost'):
+            shell = self._shell()
+            done = False
+            try:
+                yield from shell.run(command, time.monotonic() + timeout, max_bytes, result)
+                done = True
+            finally:
+                if done:
+                    self._release(shell)
+                else:
+                    shell.kill()
+
+    # returns the path, if command only prints a file
+    def _file(self, command: str) -> [None,str]:
+        m = _CAT.match(command)
+        if m is None:
+            return None
+
+        return next(g for g in m.groups() if g is not None)
+
+    def _readLines(self, path: str, max_bytes: [None,int]):
+        with open(path, 'rb') as f:
+            yield from split_lines(iter(lambda: f.read(CHUNK_SIZE), b''), max_bytes)
+
+    # return(bytes: stdout, bytes: stderr, int: retcode)
+    def exec(self, command: str):
+        path = self._file(command)
+        if path is not None:
+            try:
+                return (self.readFile(path), b'', 0)
+            except OSError as e:
+                return (b'', f'cat: {path}: {e.strerror}'.encode(), 1)
+
+        result = {}
+        stdout = b'\n'.join(self._run(command, None, self._timeout, result))
+        return (stdout.strip(), result['stderr'], result['retcode'])
+
+    def execHandleStderror(self, command: str):
+        out = self.exec(command)
+
+        if out[2] != 0:
+            logger.error(f'Command returned error {out[2]}: {out[1]}')
+            raise Exception(f'Command returned error {out[2]}: {out[1]}')
+
+        return out[0]
+
+    # Yields the lines of stdout as they arrive, see SshTransport.execStream()
+    def execStream(self, command: str, max_bytes: [None,int] = None, timeout: float = 5):
+        path = self._file(command)
+        if path is not None:
+            yield from self._readLines(path, max_bytes)
+            return
+
+        result = {}
+        yield from self._run(command, max_bytes, timeout, result)
+
+        if result['retcode'] != 0:
+            logger.error(f'Command returned error {result["retcode"]}: {result["stderr"]}')
+            raise Exception(f'Command returned error {result["retcode"]}: {result["stderr"]}')
+
+    def readFile(self, path: str):
+        with open(path, 'rb') as f:
+            return f.read().strip()
+
+    async def aexec(self, command: str):
+        return await aio.run_blocking(self.exec, command)
+
+    async def aexecHandleStderror(self, command: str):
+        return await aio.run_blocking(self.execHandleStderror, command)
+
+    async def areadFile(self, path: str):
+        return await aio.run_blocking(self.readFile, path)
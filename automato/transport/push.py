@@ -0,0 +1,234 @@
+import hmac
+import ipaddress
+import json
+import logging
+import socket
+import socketserver
+import threading
+
+from automato import metrics
+from automato.transport import Transport, HOLD
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 7755
+
+# Maximum length of a single message in bytes
+MAX_MESSAGE = 1048576
+
+'''
+Push protocol
+
+Agents (see automato.agent) connect to the central process over TCP and send
+newline-delimited JSON messages. The first message identifies the agent:
+  {"agent": "host1", "token": "secret"}
+Every further message updates a state:
+  {"state": "load", "set": {"1": 0.5}, "unset": ["key"], "full": true}
+`set` holds changed keys, `unset` removed keys. With `full`, the message
+replaces all data of the state. Agents send every state in full after
+connecting and only the changes afterwards.
+'''
+
+def encode(message: dict) -> bytes:
+    return json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n'
+
+# returns the data of a state after applying message to it
+def apply(data: dict, message: dict) -> dict:
+    data = {} if message.get('full') else dict(data)
+    data.update(message.get('set', {}))
+    for k in message.get('unset', []):
+        data.pop(k, None)
+
+    return data
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _read(self) -> [None,dict]:
+        line = self.rfile.readline(MAX_MESSAGE)
+        if not line:
+            return None
+
+        if not line.endswith(b'\n'):
+            raise ValueError(f'Message longer than {MAX_MESSAGE} bytes')
+
+        message = json.loads(line)
+        if not isinstance(message, dict):
+            raise ValueError('Message is not an object')
+
+        return message
+
+    def handle(self):
+        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        peer = self.client_address[0]
+
+        try:
+            hello = self._read() or {}
+            agent = hello.get('agent')
+
+            tp = self.server.transport(agent) if isinstance(agent, str) else None
+            if tp is None or not tp.authenticate(hello.get('token')):
+                logger.warning(f'Rejected agent "{agent}" from {peer}')
+                return
+
+            logger.info(f'Agent "{agent}" connected from {peer}')
+            while True:
+                message = self._read()
+                if message is None:
+                    break
+
+                self.server.receive(agent, message)
+        except (OSError, ValueError) as e:
+            logger.error(f'Connection of agent from {peer} failed: {e}')
+            return
+
+        logger.info(f'Agent "{agent}" disconnected')
+
+'''
+_Server accepts agents on one address for all PushTransports using it.
+It keeps the data pushed by every agent, so agents stay connected and their
+data is kept while their endpoint is reloaded. It is started by the first
+PushTransport and runs until the process exits.
+'''
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple):
+        super().__init__(address, _Handler)
+        self._transports = {}
+        self._data = {}
+        self._lock = threading.Lock()
+
+        threading.Thread(target=self.serve_forever, name=f'automato-push-{address[1]}', daemon=True).start()
+        logger.info(f'Accepting agents on {address[0]}:{address[1]}')
+
+    def register(self, agent: str, tp):
+        with self._lock:
+            self._transports[agent] = tp
+
+    def unregister(self, agent: str, tp):
+        with self._lock:
+            if self._transports.get(agent) is tp:
+                del self._transports[agent]
+
+    def transport(self, agent: str):
+        with self._lock:
+            return self._transports.get(agent)
+
+    def data(self, agent: str, state: str) -> [None,dict]:
+        with self._lock:
+            return self._data.get(agent, {}).get(state)
+
+    def receive(self, agent: str, message: dict):
+        state = message.get('state')
+        if not isinstance(state, str) or not isinstance(message.get('set', {}), dict) or not isinstance(message.get('unset', []), list):
+            logger.error(f'Agent "{agent}" pushed an invalid message')
+            return
+
+        metrics.PUSH_RECEIVED.inc(agent=agent)
+        with self._lock:
+            states = self._data.setdefault(agent, {})
+            states[state] = apply(states.get(state, {}), message)
+            data = states[state]
+            tp = self._transports.get(agent)
+
+        if tp is not None:
+            tp.update(state, data)
+
+def _isLoopback(address: str) -> bool:
+    if address == 'localhost':
+        return True
+
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+# (address, port) -> _Server
+_servers = {}
+_servers_lock = threading.Lock()
+
+def _server(address: str, port: int) -> _Server:
+    with _servers_lock:
+        if (address, port) not in _servers:
+            _servers[(address, port)] = _Server((address, port))
+
+        return _servers[(address, port)]
+
+'''
+PushTransport receives the states pushed by the agent running on the
+endpoint, see automato.agent and automato.state.push.PushState.
+It does not connect anywhere, the agent connects to it. All PushTransports
+with the same address and port share one listening socket.
+
+REQUIRED ARGUMENTS
+    agent: Name the agent identifies with
+OPTIONAL ARGUMENTS
+    address, port: Address to accept agents on. Only local agents are
+      accepted by default
+    token: Shared secret the agent has to send. Required for any address
+      but loopback
+'''
+class PushTransport(Transport):
+    CONNECTION = HOLD
+
+    def _init(self, agent: str, address: str = '127.0.0.1', port: int = DEFAULT_PORT, token: [None,str] = None):
+        if token is None and not _isLoopback(address):
+            logger.error(f'Agent "{agent}": Accepting agents on {address} requires a token')
+            raise Exception(f'Accepting agents on {address} requires a token')
+
+        self._agent = agent
+        self._address = address
+        self._port = port
+        self._token = token
+
+        self._server = None
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def connect(self):
+        self._server = _server(self._address, self._port)
+        self._server.register(self._agent, self)
+
+        # States subscribed before get what the agent pushed so far
+        with self._lock:
+            states = list(self._subscribers)
+
+        for state in states:
+            data = self._server.data(self._agent, state)
+            if data is not None:
+                self.update(state, data)
+
+        self._connected = True
+
+    def disconnect(self):
+        if self._server is not None:
+            self._server.unregister(self._agent, self)
+
+        self._connected = False
+
+    def authenticate(self, token) -> bool:
+        if self._token is None:
+            return True
+
+        return isinstance(token, str) and hmac.compare_digest(token.encode('utf-8'), self._token.encode('utf-8'))
+
+    # callback(data: dict) is called with the data of state whenever it changes
+    def subscribe(self, state: str, callback):
+        with self._lock:
+            self._subscribers.setdefault(state, []).append(callback)
+
+        data = self._server.data(self._agent, state) if self._server is not None else None
+        if data is not None:
+            callback(data)
+
+    def unsubscribe(self, state: str, callback):
+        with self._lock:
+            if callback in self._subscribers.get(state, []):
+                self._subscribers[state].remove(callback)
+
+    def update(self, state: str, data: dict):
+        with self._lock:
+            callbacks = list(self._subscribers.get(state, []))
+
+        for callback in callbacks:
+            callback(data)
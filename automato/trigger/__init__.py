@@ -1,11 +1,18 @@
 from typing import Dict
-from pyparsing import alphanums, alphas, printables, pyparsing_common, pyparsing_common, Word, infix_notation, CaselessKeyword, opAssoc, ParserElement
+import functools
+import random
+from pyparsing import alphanums, alphas, printables, pyparsing_common, pyparsing_common, Word, infix_notation, CaselessKeyword, opAssoc, ParserElement, one_of, Suppress, Forward
 import time
 import logging
 logger = logging.getLogger(__name__)
 
 from automato import endpoint
 from automato import misc
+from automato import aio
+from automato import metrics
+from automato.trigger import expression
+from automato.state.history import AGGREGATES
+from automato import fleet
 
 
 
@@ -15,20 +22,55 @@ Implementations of Trigger:
 MUST implement:
   _evaluate(self, action: str) -> bool
     evaluates the instace for action given by 'action'.
-    Provided configuration is stored in self._instances[action]['args']
+    Provided configuration is stored in self._instances[action].args
 
 CAN implement:
   _addInstance(self, action: str)
     Called afer 'action' was added.
+  _aevaluate(self, action: str) -> bool
+    async counterpart of _evaluate(). By default, _evaluate() is run in the
+    blocking call pool.
+  _refresh(self, action: str), _arefresh(self, action: str)
+    Called before every re-evaluation, eg. to collect states.
+  close(self)
+    Called before the trigger is discarded, eg. on reload.
+
+CAN set:
+  INSTANCE
+    class of the records in self._instances, a subclass of Instance
+    with additional __slots__ for own bookkeeping.
+  EVENT_DRIVEN
+    If True, _evaluate() is only called if the instance was marked as changed
+    with markDirty() since its last evaluation. Otherwise the cached result
+    is returned.
 
 SHOULDNT implement:
   evaluate(self, action: str) -> bool
     Only calls _evaluate(), if no check was performed in configured interval,
     otherwise returns cached result
+  aevaluate(self, action: str) -> bool
   addInstance(self, action:str, interval=30, **kwargs)
+  markDirty(self, action: str)
+  nextEvaluation(self, action: str) -> float
+    time at which the instance has to be re-evaluated
+  dumpSnapshot(self) -> dict, loadSnapshot(self, snapshot: dict)
+  stagger(self)
+    spreads the next evaluation of all instances randomly over their interval
 '''
+class Instance:
+    __slots__ = ('lastupdate', 'interval', 'last', 'dirty', 'args')
+
+    def __init__(self, interval: int, args: dict):
+        self.lastupdate = 0
+        self.interval = interval
+        self.last = False
+        self.dirty = True
+        self.args = args
+
 class Trigger:
     NEEDS_CONTEXT = False
+    EVENT_DRIVEN = False
+    INSTANCE = Instance
 
     @staticmethod
     def create(classname: str, **kwargs):
@@ -41,15 +83,64 @@ class Trigger:
         pass
 
     def addInstance(self, action: str, interval: int=30, **kwargs):
-        self._instances[action] = {'lastupdate':0,'interval':interval,'last':False,'args':kwargs}
+        self._instances[action] = self.INSTANCE(interval, kwargs)
         self._addInstance(action)
         logger.debug(f'Trigger: Action "{action}" registered.')
 
+    def dumpSnapshot(self) -> dict:
+        return {k: {'last': v.last, 'lastupdate': v.lastupdate} for k, v in self._instances.items()}
+
+    def loadSnapshot(self, snapshot: dict):
+        for k in snapshot:
+            if k in self._instances:
+                self._instances[k].last = snapshot[k]['last']
+                self._instances[k].lastupdate = snapshot[k]['lastupdate']
+
+    def close(self):
+        pass
+
+    def stagger(self):
+        now = time.time()
+        for k, v in self._instances.items():
+            phase = now - random.uniform(0, v.interval)
+            v.lastupdate = phase if v.lastupdate == 0 else min(v.lastupdate, phase)
+
+    def markDirty(self, action: str):
+        self._instances[action].dirty = True
+
+    def _refresh(self, action: str):
+        pass
+
+    async def _arefresh(self, action: str):
+        pass
+
+    # Clears the dirty flag. Returns False if the instance does not need
+    # to be re-evaluated.
+    def _clearDirty(self, action: str) -> bool:
+        if not self.EVENT_DRIVEN:
+            return True
+
+        if not self._instances[action].dirty:
+            logger.debug(f'Conditions for action "{action}" did not change')
+            self._instances[action].lastupdate = time.time()
+            return False
+
+        self._instances[action].dirty = False
+        return True
+
+    # A failed evaluation is retried after the interval, not on every run
+    def _failed(self, action: str):
+        self._instances[action].lastupdate = time.time()
+        self._instances[action].dirty = True
+
     def _evaluate(self, action: str) -> bool:
         raise NotImplemented
 
+    def nextEvaluation(self, action: str) -> float:
+        return self._instances[action].lastupdate + self._instances[action].interval
+
     def _shouldReevaluate(self, action: str) -> bool:
-        return time.time() - self._instances[action]['lastupdate'] > self._instances[action]['interval']
+        return time.time() >= self.nextEvaluation(action)
 
     def evaluate(self, action: str) -> bool:
         if action not in self._instances:
@@ -57,14 +148,50 @@ class Trigger:
             return False
 
         if self._shouldReevaluate(action):
-            logger.debug(f'Re-evaluating trigger condition for action "{action}"')
-            result =  self._evaluate(action)
+            try:
+                self._refresh(action)
+                if not self._clearDirty(action):
+                    return self._instances[action].last
+
+                logger.debug(f'Re-evaluating trigger condition for action "{action}"')
+                with metrics.TRIGGER_EVALUATE.time(trigger=type(self).__name__, action=action):
+                    result = self._evaluate(action)
+            except Exception:
+                self._failed(action)
+                raise
+
+            self._instances[action].last = result
+            self._instances[action].lastupdate = time.time()
+            return result
+
+        return self._instances[action].last
+
+    async def _aevaluate(self, action: str) -> bool:
+        return await aio.run_blocking(self._evaluate, action)
+
+    async def aevaluate(self, action: str) -> bool:
+        if action not in self._instances:
+            logger.error(f'Trigger: Action "{action}" was not found. Evaluating to False.')
+            return False
+
+        if self._shouldReevaluate(action):
+            try:
+                await self._arefresh(action)
+                if not self._clearDirty(action):
+                    return self._instances[action].last
 
-            self._instances[action]['last'] = result
-            self._instances[action]['lastupdate'] = time.time()
+                logger.debug(f'Re-evaluating trigger condition for action "{action}"')
+                with metrics.TRIGGER_EVALUATE.time(trigger=type(self).__name__, action=action):
+                    result = await self._aevaluate(action)
+            except Exception:
+                self._failed(action)
+                raise
+
+            self._instances[action].last = result
+            self._instances[action].lastupdate = time.time()
             return result
 
-        return self._instances[action]['last']
+        return self._instances[action].last
 
 '''
 ```yaml
@@ -77,60 +204,168 @@ conditional:
     - host1.user.bob > 0
 ```
 '''
+class ConditionalInstance(Instance):
+    __slots__ = ('conditions', 'variables')
+
 class ConditionalTrigger(Trigger):
     NEEDS_CONTEXT = True
+    EVENT_DRIVEN = True
+    INSTANCE = ConditionalInstance
 
     def __init__(self, endpoints: Dict[str, endpoint.Endpoint]):
         super().__init__()
 
         self._endpoints = endpoints
+        # Distinct nodes of all conditions, see expression.Graph
+        self._graph = expression.Graph()
+        # Dependency graph. (endpoint, state) -> {key: set(actions)}
+        self._dependents = {}
+        # (endpoint, state) -> {key: set(Variables)}
+        self._variables = {}
+        self._watches = []
         self._setup_parser()
 
     def _setup_parser(self):
         ParserElement.enable_packrat()
 
-        boolean = CaselessKeyword('True').setParseAction(lambda x: True) | CaselessKeyword('False').setParseAction(lambda x: False)
-        integer = pyparsing_common.integer
+        constant = lambda value: self._graph.add(expression.Constant(value))
+        boolean = CaselessKeyword('True').setParseAction(lambda x: constant(True)) | CaselessKeyword('False').setParseAction(lambda x: constant(False))
+        real = pyparsing_common.real.copy().add_parse_action(lambda x: constant(x[0]))
+        integer = pyparsing_common.integer.copy().add_parse_action(lambda x: constant(x[0]))
         variable = Word(alphanums + '.').setParseAction(self._parseVariable)
-        operand = boolean | integer | variable
+        aggregate = (one_of(AGGREGATES) + Suppress('(') + variable + Suppress(')')).setParseAction(self._parseAggregate)
+        condition = Forward()
+        fleet_aggregate = (one_of(list(fleet.AGGREGATES)) + Suppress('(') + condition + Suppress(')')).setParseAction(self._parseFleetAggregate)
+        operand = boolean | aggregate | fleet_aggregate | real | integer | variable
 
-        self._parser = infix_notation(
+        self._parser = condition << infix_notation(
                 operand,
                 [
-                    ('not', 1, opAssoc.RIGHT, lambda a: not a[0][1]),
-                    ('and', 2, opAssoc.LEFT, lambda a: a[0][0] and a[0][2]),
-                    ('or', 2, opAssoc.LEFT, lambda a: a[0][0] or a[0][2]),
-                    ('==', 2, opAssoc.LEFT, lambda a: a[0][0] == a[0][2]),
-                    ('>', 2, opAssoc.LEFT, lambda a: a[0][0] > a[0][2]),
-                    ('>=', 2, opAssoc.LEFT, lambda a: a[0][0] >= a[0][2]),
-                    ('<', 2, opAssoc.LEFT, lambda a: a[0][0] < a[0][2]),
-                    ('<=', 2, opAssoc.LEFT, lambda a: a[0][0] <= a[0][2]),
-                    ('+', 2, opAssoc.LEFT, lambda a: a[0][0] + a[0][2]),
-                    ('-', 2, opAssoc.LEFT, lambda a: a[0][0] - a[0][2]),
-                    ('*', 2, opAssoc.LEFT, lambda a: a[0][0] * a[0][2]),
-                    ('/', 2, opAssoc.LEFT, lambda a: a[0][0] / a[0][2]),
+                    ('not', 1, opAssoc.RIGHT, self._graph.compileUnary),
+                    ('and', 2, opAssoc.LEFT, self._graph.compileBinary),
+                    ('or', 2, opAssoc.LEFT, self._graph.compileBinary),
+                    ('==', 2, opAssoc.LEFT, self._graph.compileBinary),
+                    ('>', 2, opAssoc.LEFT, self._graph.compileBinary),
+                    ('>=', 2, opAssoc.LEFT, self._graph.compileBinary),
+                    ('<', 2, opAssoc.LEFT, self._graph.compileBinary),
+                    ('<=', 2, opAssoc.LEFT, self._graph.compileBinary),
+                    ('+', 2, opAssoc.LEFT, self._graph.compileBinary),
+                    ('-', 2, opAssoc.LEFT, self._graph.compileBinary),
+                    ('*', 2, opAssoc.LEFT, self._graph.compileBinary),
+                    ('/', 2, opAssoc.LEFT, self._graph.compileBinary),
                 ]
             )
 
+        # Compiled conditions, keyed by their text. Shared by all actions.
+        self._compiled = {}
+
     def _parseVariable(self, var):
-        logger.debug(f'Looking up variable "{var[0]}"')
         endpoint, key = var[0].split('.',1)
 
         if not endpoint in self._endpoints:
             logger.error(f'Parser: Endpoint "{endpoint}" not found')
-            return None
+            return self._graph.add(expression.Constant(None))
+
+        return self._graph.add(expression.Variable(var[0], self._endpoints[endpoint], key))
+
+    def _parseAggregate(self, tokens):
+        function, var = tokens
+        if not isinstance(var, expression.Variable):
+            return var
+
+        # Over a fleet, aggregates reduce over its members instead of the history
+        if isinstance(self._endpoints[var.endpoint_name], fleet.Fleet):
+            if function not in fleet.AGGREGATES:
+                logger.error(f'Parser: "{function}" can not be used on fleet "{var.endpoint_name}"')
+                raise Exception(f'"{function}" can not be used on fleet "{var.endpoint_name}"')
+
+            return self._graph.add(expression.FleetAggregate(function, var))
+
+        return self._graph.add(expression.Aggregate(function, var))
+
+    def _parseFleetAggregate(self, tokens):
+        function, operand = tokens
+        return self._graph.add(expression.FleetAggregate(function, operand))
+
+    def _compile(self, condition: str) -> expression.Node:
+        if condition not in self._compiled:
+            logger.debug(f'Compiling condition "{condition}"')
+            self._compiled[condition] = self._parser.parse_string(condition)[0]
+
+        return self._compiled[condition]
+
+    def _addInstance(self, action: str):
+        self._instances[action].conditions = [
+                (str(s), self._compile(str(s))) for s in self._instances[action].args['when']
+            ]
+
+        for s, condition in self._instances[action].conditions:
+            if condition.isColumn():
+                logger.error(f'Condition "{s}" of action "{action}" reads a fleet, but is not reduced to a single value')
+                raise Exception(f'Condition "{s}" has to reduce the values of the fleet, eg. by count() or any()')
+
+        # one variable per state is enough to refresh it
+        states = {}
+        for _, condition in self._instances[action].conditions:
+            for var in condition.variables():
+                self._addDependency(action, var)
+                states[(var.endpoint_name, var.state)] = var
 
-        return self._endpoints[endpoint].getState(key)
+        self._instances[action].variables = list(states.values())
+
+    def _addDependency(self, action: str, var: expression.Variable):
+        state = (var.endpoint_name, var.state)
+
+        if state not in self._dependents:
+            self._dependents[state] = {}
+            listener = functools.partial(self._stateChanged, state)
+            var.watch(listener)
+            self._watches.append((var, listener))
+
+        self._dependents[state].setdefault(var.state_key, set()).add(action)
+        self._variables.setdefault(state, {}).setdefault(var.state_key, set()).add(var)
+
+    def close(self):
+        for var, listener in self._watches:
+            var.unwatch(listener)
+
+        self._watches = []
+
+    def _stateChanged(self, state: tuple, changed: [None,set]):
+        for key, actions in self._dependents[state].items():
+            if changed is None or any([key == c or key.startswith(f'{c}.') for c in changed]):
+                for var in self._variables[state][key]:
+                    var.invalidate()
+
+                for action in actions:
+                    self.markDirty(action)
+
+    def _refresh(self, action: str):
+        for var in self._instances[action].variables:
+            var.refresh()
+
+    async def _arefresh(self, action: str):
+        for var in self._instances[action].variables:
+            await var.arefresh()
 
     def _evaluate(self, action: str) -> bool:
-        logger.debug(f"{self._instances[action]['args']['when']}")
+        logger.debug(f"{self._instances[action].args['when']}")
 
         results = []
 
-        for s in self._instances[action]['args']['when']:
-            r = self._parser.parse_string(str(s))[0]
+        for s, condition in self._instances[action].conditions:
+            r = condition.evaluate()
             logger.debug(f'Condition "{s}" evaluated to "{r}"')
             results.append(r)
 
         return all(results)
 
+    async def _aevaluate(self, action: str) -> bool:
+        results = []
+
+        for s, condition in self._instances[action].conditions:
+            r = await condition.aevaluate()
+            logger.debug(f'Condition "{s}" evaluated to "{r}"')
+            results.append(r)
+
+        return all(results)
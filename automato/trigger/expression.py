@@ -0,0 +1,374 @@
+import operator
+import logging
+
+from automato import fleet
+
+logger = logging.getLogger(__name__)
+
+'''
+Compiled condition expressions
+
+Conditions are parsed once into Nodes. Nodes are added to a Graph, which
+shares equal sub-expressions, eg. `host1.user.jonas > 0`, between all
+conditions of a trigger.
+
+Every node caches its value until it is invalidated. Variables are
+invalidated by the trigger when their state changed, which invalidates all
+nodes depending on them. So a sub-expression used by many actions is only
+evaluated once per change of its states. States have to be refreshed before
+evaluating, see Variable.refresh().
+
+Nodes MUST implement:
+  _evaluate(self)
+  _aevaluate(self)
+  key(self) -> str
+    identifies equal nodes
+  variables(self) -> list
+    all Variables read by this node and its children
+
+CAN implement:
+  children(self) -> list
+  isColumn(self) -> bool
+    True if the node evaluates to a fleet.Column, see automato.fleet
+
+SHOULDNT implement:
+  evaluate(self), aevaluate(self)
+  invalidate(self)
+'''
+class Node:
+    _valid = False
+    _version = 0
+    _cache = None
+    _parents = ()
+
+    def _evaluate(self):
+        raise NotImplemented
+
+    async def _aevaluate(self):
+        raise NotImplemented
+
+    def key(self) -> str:
+        raise NotImplemented
+
+    def variables(self) -> list:
+        raise NotImplemented
+
+    def children(self) -> list:
+        return []
+
+    def isColumn(self) -> bool:
+        return any([c.isColumn() for c in self.children()])
+
+    def invalidate(self):
+        self._version += 1
+        self._valid = False
+
+        for parent in self._parents:
+            parent.invalidate()
+
+    # Results computed while the node was invalidated are not cached
+    def _store(self, version: int, value):
+        if version == self._version:
+            self._cache = value
+            self._valid = True
+
+    def evaluate(self):
+        if self._valid:
+            return self._cache
+
+        version = self._version
+        value = self._evaluate()
+        self._store(version, value)
+        return value
+
+    async def aevaluate(self):
+        if self._valid:
+            return self._cache
+
+        version = self._version
+        value = await self._aevaluate()
+        self._store(version, value)
+        return value
+
+class Constant(Node):
+    def __init__(self, value):
+        self._value = value
+
+    def _evaluate(self):
+        return self._value
+
+    async def _aevaluate(self):
+        return self._value
+
+    def key(self) -> str:
+        return f'{type(self._value).__name__}:{self._value!r}'
+
+    def variables(self) -> list:
+        return []
+
+'''
+Variable references a value in the format <state>.<key> of an endpoint.
+'''
+class Variable(Node):
+    def __init__(self, name: str, endpoint, key: str):
+        self._name = name
+        self._endpoint = endpoint
+        self._key = key
+
+        self.endpoint_name = name.split('.', 1)[0]
+        self.state, _, self.state_key = key.partition('.')
+
+    def refresh(self):
+        self._endpoint.refreshState(self.state)
+
+    async def arefresh(self):
+        await self._endpoint.arefreshState(self.state)
+
+    def history(self):
+        return self._endpoint.getHistory(self._key)
+
+    def watch(self, listener):
+        self._endpoint.addStateListener(self.state, listener)
+
+    def unwatch(self, listener):
+        self._endpoint.removeStateListener(self.state, listener)
+
+    def key(self) -> str:
+        return self._name
+
+    def variables(self) -> list:
+        return [self]
+
+    def isColumn(self) -> bool:
+        return isinstance(self._endpoint, fleet.Fleet)
+
+    def _evaluate(self):
+        logger.debug(f'Looking up variable "{self._name}"')
+        return self._endpoint.getState(self._key)
+
+    async def _aevaluate(self):
+        logger.debug(f'Looking up variable "{self._name}"')
+        return await self._endpoint.agetState(self._key)
+
+'''
+Aggregate evaluates to an aggregate of the history of a Variable,
+eg. avg(host1.load.1). See automato.state.history for the functions.
+'''
+class Aggregate(Node):
+    def __init__(self, function: str, variable: Variable):
+        self._function = function
+        self._variable = variable
+        self._history = variable.history()
+
+    def _aggregate(self):
+        if self._history is None:
+            return None
+
+        return getattr(self._history, self._function)()
+
+    def _evaluate(self):
+        self._variable.refresh()
+        return self._aggregate()
+
+    async def _aevaluate(self):
+        await self._variable.arefresh()
+        return self._aggregate()
+
+    def key(self) -> str:
+        return f'{self._function}({self._variable.key()})'
+
+    def children(self) -> list:
+        return [self._variable]
+
+    def variables(self) -> list:
+        return [self._variable]
+
+'''
+FleetAggregate reduces a fleet Column, eg. count(web.load.1 > 4).
+See automato.fleet for the functions.
+'''
+class FleetAggregate(Node):
+    def __init__(self, function: str, operand: Node):
+        self._function = function
+        self._operand = operand
+
+    def _evaluate(self):
+        return fleet.aggregate(self._function, self._operand.evaluate())
+
+    async def _aevaluate(self):
+        return fleet.aggregate(self._function, await self._operand.aevaluate())
+
+    def key(self) -> str:
+        return f'fleet.{self._function}({self._operand.key()})'
+
+    def isColumn(self) -> bool:
+        return False
+
+    def children(self) -> list:
+        return [self._operand]
+
+    def variables(self) -> list:
+        return self._operand.variables()
+
+class UnaryOperation(Node):
+    def __init__(self, op, operand: Node):
+        self._op = op
+        self._operand = operand
+
+    def _apply(self, value):
+        if value is None:
+            return None
+
+        if isinstance(value, fleet.Column):
+            return value.map(self._op)
+
+        return self._op(value)
+
+    def _evaluate(self):
+        return self._apply(self._operand.evaluate())
+
+    async def _aevaluate(self):
+        return self._apply(await self._operand.aevaluate())
+
+    def key(self) -> str:
+        return f'({self._op.__name__} {self._operand.key()})'
+
+    def children(self) -> list:
+        return [self._operand]
+
+    def variables(self) -> list:
+        return self._operand.variables()
+
+class BinaryOperation(Node):
+    def __init__(self, op, left: Node, right: Node):
+        self._op = op
+        self._left = left
+        self._right = right
+
+    # A missing value, eg. of a state that was not pushed yet, makes the
+    # result missing. Conditions evaluating to None are not met.
+    def _apply(self, left, right):
+        if left is None or right is None:
+            return None
+
+        return self._op(left, right)
+
+    def _evaluate(self):
+        return self._apply(self._left.evaluate(), self._right.evaluate())
+
+    async def _aevaluate(self):
+        return self._apply(await self._left.aevaluate(), await self._right.aevaluate())
+
+    def _name(self) -> str:
+        return self._op.__name__
+
+    def key(self) -> str:
+        return f'({self._left.key()} {self._name()} {self._right.key()})'
+
+    def children(self) -> list:
+        return [self._left, self._right]
+
+    def variables(self) -> list:
+        return self._left.variables() + self._right.variables()
+
+# and/or only evaluate the right side if needed, like python does.
+# On a fleet.Column they work on every row.
+class And(BinaryOperation):
+    def _evaluate(self):
+        left = self._left.evaluate()
+        if isinstance(left, fleet.Column):
+            return left._apply(lambda a, b: a and b, self._right.evaluate())
+
+        return left and self._right.evaluate()
+
+    async def _aevaluate(self):
+        left = await self._left.aevaluate()
+        if isinstance(left, fleet.Column):
+            return left._apply(lambda a, b: a and b, await self._right.aevaluate())
+
+        return left and await self._right.aevaluate()
+
+    def _name(self) -> str:
+        return 'and'
+
+class Or(BinaryOperation):
+    def _evaluate(self):
+        left = self._left.evaluate()
+        if isinstance(left, fleet.Column):
+            return left._apply(lambda a, b: a or b, self._right.evaluate())
+
+        return left or self._right.evaluate()
+
+    async def _aevaluate(self):
+        left = await self._left.aevaluate()
+        if isinstance(left, fleet.Column):
+            return left._apply(lambda a, b: a or b, await self._right.aevaluate())
+
+        return left or await self._right.aevaluate()
+
+    def _name(self) -> str:
+        return 'or'
+
+UNARY_OPERATORS = {
+    'not': operator.not_,
+}
+
+BINARY_OPERATORS = {
+    '==': operator.eq,
+    '>':  operator.gt,
+    '>=': operator.ge,
+    '<':  operator.lt,
+    '<=': operator.le,
+    '+':  operator.add,
+    '-':  operator.sub,
+    '*':  operator.mul,
+    '/':  operator.truediv,
+}
+
+'''
+Graph holds the distinct nodes of all conditions of a trigger.
+add() returns the existing node, if an equal one was added before, and
+links nodes to their parents for invalidation.
+'''
+class Graph:
+    def __init__(self):
+        self._nodes = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def add(self, node: Node) -> Node:
+        key = node.key()
+        if key in self._nodes:
+            return self._nodes[key]
+
+        node._parents = []
+        for child in node.children():
+            if not isinstance(child._parents, list):
+                child._parents = []
+            child._parents.append(node)
+
+        self._nodes[key] = node
+        return node
+
+    # pyparsing parse actions building the graph for infix_notation()
+    def compileUnary(self, tokens) -> Node:
+        op, operand = tokens[0]
+        return self.add(UnaryOperation(UNARY_OPERATORS[op], operand))
+
+    # Operators of the same precedence are grouped, eg. [a, '+', b, '+', c]
+    def compileBinary(self, tokens) -> Node:
+        t = tokens[0]
+        node = t[0]
+
+        for i in range(1, len(t), 2):
+            op, right = t[i], t[i+1]
+
+            if op == 'and':
+                node = self.add(And(None, node, right))
+            elif op == 'or':
+                node = self.add(Or(None, node, right))
+            else:
+                node = self.add(BinaryOperation(BINARY_OPERATORS[op], node, right))
+
+        return node
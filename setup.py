@@ -8,7 +8,11 @@ setup(
     version='0.0.0',
     packages=find_packages(),
     entry_points = {
-        'console_scripts': ['automato=automato.command_line:main'],
+        'console_scripts': [
+            'automato=automato.command_line:main',
+            'automato-benchmark=automato.benchmark:main',
+            'automato-agent=automato.agent:main',
+        ],
     },
     # TODO Check them
     install_requires=[
@@ -0,0 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import pytest
+
+from automato import action
+
+class FakeEndpoint:
+    def __init__(self, duration: float):
+        self.duration = duration
+        self.executed = []
+
+    def hasCommand(self, cmd: str) -> bool:
+        return True
+
+    def executeCommand(self, cmd: str, **kwargs):
+        time.sleep(self.duration)
+        self.executed.append(cmd)
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(action, '_dispatcher', pool)
+    yield pool
+    pool.shutdown(wait=True)
+
+def build(endpoints: dict, then: list, **config) -> action.Action:
+    return action.Action('a', dict(config, trigger=[], then=then), endpoints, {})
+
+def test_queued_commands_do_not_time_out(dispatcher):
+    endpoints = {'h1': FakeEndpoint(0.2), 'h2': FakeEndpoint(0.2)}
+    act = build(endpoints, [{'h1.cmd': None}, {'h2.cmd': None}], timeout=0.3)
+
+    act.execute()
+
+    assert act.lastResults() == [('h1.cmd', 'ok'), ('h2.cmd', 'ok')]
+
+def test_running_command_times_out(dispatcher):
+    endpoints = {'h1': FakeEndpoint(0.5), 'h2': FakeEndpoint(0)}
+    act = build(endpoints, [{'h1.cmd': None}, {'h1.next': None}, {'h2.cmd': None}], timeout=0.1)
+
+    act.execute()
+
+    assert act.lastResults() == [('h1.cmd', 'timeout'), ('h1.next', 'skipped'), ('h2.cmd', 'ok')]
+
+def test_failed_command_skips_its_chain():
+    class Failing(FakeEndpoint):
+        def executeCommand(self, cmd: str, **kwargs):
+            raise Exception('failed')
+
+    act = build({'h1': Failing(0), 'h2': FakeEndpoint(0)}, [{'h1.cmd': None}, {'h1.next': None}, {'h2.cmd': None}])
+    act.execute()
+
+    assert act.lastResults() == [('h1.cmd', 'failed'), ('h1.next', 'skipped'), ('h2.cmd', 'ok')]
+
+def test_unknown_command_is_rejected():
+    class Missing(FakeEndpoint):
+        def hasCommand(self, cmd: str) -> bool:
+            return False
+
+    with pytest.raises(Exception):
+        build({'h1': Missing(0)}, [{'h1.cmd': None}])
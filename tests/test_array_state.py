@@ -0,0 +1,67 @@
+import pytest
+
+from automato.state import LinuxLoadState, LinuxMemoryState
+
+MEMINFO = b'''MemTotal:       16303392 kB
+MemFree:         1234567 kB
+MemAvailable:    8765432 kB
+HugePages_Total:       0
+'''
+
+def test_load_values_are_numbers():
+    stt = LinuxLoadState({}, transport=None)
+    stt.collectOutput(b'0.52 1.25 10.00 2/345 6789\n')
+
+    assert stt.get('1') == 0.52
+    assert stt.get('5') == 1.25
+    assert stt.get('15') == 10
+    assert stt.get('1') > 0.5
+
+def test_invalid_load_keeps_previous_values():
+    stt = LinuxLoadState({}, transport=None)
+    stt.collectOutput(b'0.52 1.25 10.00 2/345 6789\n')
+
+    with pytest.raises(Exception):
+        stt.collectOutput(b'0.52\n')
+
+    assert stt.get('1') == 0.52
+
+def test_memory_values_are_integers():
+    stt = LinuxMemoryState({}, transport=None)
+    stt.collectOutput(MEMINFO)
+
+    assert stt.get('MemAvailable') == 8765432
+    assert stt.get('HugePages_Total') == 0
+    # Keys of the old format
+    assert stt.get('mem.MemTotal') == 16303392
+    assert stt.get('mem') == {'MemTotal': 16303392, 'MemFree': 1234567, 'MemAvailable': 8765432, 'HugePages_Total': 0}
+    assert stt.get('Missing') is None
+
+def test_layout_is_shared():
+    first = LinuxMemoryState({}, transport=None)
+    second = LinuxMemoryState({}, transport=None)
+    first.collectOutput(MEMINFO)
+    second.collectOutput(MEMINFO)
+
+    assert first._index is second._index
+
+def test_changed_keys():
+    stt = LinuxMemoryState({}, transport=None)
+    stt.collectOutput(MEMINFO)
+
+    changes = []
+    stt.addListener(changes.append)
+    stt.collectOutput(MEMINFO.replace(b'1234567', b'7654321'))
+    stt.collectOutput(MEMINFO.replace(b'1234567', b'7654321'))
+
+    assert changes == [{'MemFree', 'mem'}]
+
+def test_snapshot():
+    stt = LinuxMemoryState({}, transport=None)
+    stt.collectOutput(MEMINFO)
+
+    restored = LinuxMemoryState({}, transport=None)
+    restored.loadSnapshot(stt.dumpSnapshot())
+
+    assert restored.toDict() == stt.toDict()
+    assert restored._last_collected == stt._last_collected
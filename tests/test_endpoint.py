@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from automato import command_line, metrics
+from automato.benchmark import FakeSshTransport
+from automato.endpoint import Endpoint
+
+OUTPUT = {
+    'cat /proc/loadavg': '0.50 0.40 0.30 1/100 1234',
+    'who': 'bob pts/0 2026-01-01 00:00\nbob pts/1 2026-01-01 00:00',
+}
+
+def endpoint(name: str, output: dict) -> Endpoint:
+    e = Endpoint(name, {
+        'transports': {'ssh': {'class': 'automato.benchmark.FakeSshTransport', 'latency': 0}},
+        'states': {
+            'load': {'class': 'automato.state.LinuxLoadState', 'transport': 'ssh', 'ttl': 30},
+            'user': {'class': 'automato.state.UserSessionState', 'transport': 'ssh', 'ttl': 30},
+        },
+    })
+    e.connectTransport()
+    e._getTransport('ssh')._output = lambda command: (output[command].encode(), b'', 0)
+
+    # States are built on first use, build them to batch them
+    e._getState('load')
+    e._getState('user')
+    return e
+
+def test_batch():
+    e = endpoint('batch', OUTPUT)
+
+    assert e.getState('load.1') == 0.5
+    assert e.getState('user.bob') == 2
+    for state in ['load', 'user']:
+        assert metrics.STATE_CACHE.get(endpoint='batch', state=state, result='miss') == 1
+    assert metrics.STATE_CACHE.get(endpoint='batch', state='user', result='hit') == 1
+
+def test_failing_state_does_not_fail_the_batch():
+    e = endpoint('broken', dict(OUTPUT, **{'cat /proc/loadavg': 'garbage'}))
+
+    assert e.getState('user.bob') == 2
+    assert e.getState('user.bob') == 2
+
+    # The failing state is collected on its own
+    with pytest.raises(Exception, match='Unexpected load average'):
+        e.getState('load.1')
+
+def test_failing_state_does_not_fail_the_async_batch():
+    e = endpoint('abroken', dict(OUTPUT, **{'cat /proc/loadavg': 'garbage'}))
+
+    assert asyncio.run(e.agetState('user.bob')) == 2
+
+class FailingTransport(FakeSshTransport):
+    def connect(self):
+        raise OSError('unreachable')
+
+def test_failing_transport_does_not_stop_the_others():
+    e = Endpoint('connect', {})
+    e._transports = {'bad': FailingTransport({}), 'good': FakeSshTransport({})}
+
+    e.connectTransport()
+    assert e._transports['good'].isConnected()
+
+    e.disconnectTransport()
+    asyncio.run(e.aconnectTransport())
+    assert e._transports['good'].isConnected()
+
+def test_failing_endpoint_does_not_stop_the_others():
+    class Failing:
+        def connectTransport(self):
+            raise OSError('unreachable')
+
+        async def aconnectTransport(self):
+            raise OSError('unreachable')
+
+    good = Endpoint('good', {'transports': {'ssh': {'class': 'automato.benchmark.FakeSshTransport'}}})
+    good._getTransport('ssh')
+    endpoints = {'bad': Failing(), 'good': good}
+
+    command_line.connect_endpoints(endpoints, 2)
+    assert good._transports['ssh'].isConnected()
+
+    good.disconnectTransport()
+    asyncio.run(command_line.aconnect_endpoints(endpoints, 2))
+    assert good._transports['ssh'].isConnected()
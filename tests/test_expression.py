@@ -0,0 +1,107 @@
+import operator
+
+from automato.trigger.expression import Graph, Constant, Variable, BinaryOperation, And
+
+class FakeEndpoint:
+    def __init__(self, values: dict, on_read=None):
+        self.values = values
+        self.reads = []
+        self.on_read = on_read
+
+    def getState(self, key: str):
+        self.reads.append(key)
+        value = self.values[key]
+        if self.on_read is not None:
+            self.on_read()
+        return value
+
+def variable(graph: Graph, endpoint: FakeEndpoint, key: str) -> Variable:
+    return graph.add(Variable(f'host1.{key}', endpoint, key))
+
+def greater(graph: Graph, left, right):
+    return graph.add(BinaryOperation(operator.gt, left, right))
+
+def test_equal_nodes_are_shared():
+    graph = Graph()
+    endpoint = FakeEndpoint({'load.1': 2})
+
+    a = greater(graph, variable(graph, endpoint, 'load.1'), graph.add(Constant(1)))
+    b = greater(graph, variable(graph, endpoint, 'load.1'), graph.add(Constant(1)))
+
+    assert a is b
+    assert len(graph) == 3
+
+def test_constants_of_different_types_are_not_shared():
+    graph = Graph()
+
+    assert graph.add(Constant(1)) is not graph.add(Constant('1'))
+    assert graph.add(Constant(1)) is not graph.add(Constant(1.5))
+
+def test_shared_node_is_evaluated_once():
+    graph = Graph()
+    endpoint = FakeEndpoint({'load.1': 2, 'user.jonas': 1})
+
+    shared = greater(graph, variable(graph, endpoint, 'load.1'), graph.add(Constant(1)))
+    first = graph.add(And(None, shared, greater(graph, variable(graph, endpoint, 'user.jonas'), graph.add(Constant(0)))))
+    second = graph.add(And(None, shared, graph.add(Constant(True))))
+
+    assert first.evaluate()
+    assert second.evaluate()
+    assert endpoint.reads == ['load.1', 'user.jonas']
+
+def test_invalidation_reaches_all_parents():
+    graph = Graph()
+    endpoint = FakeEndpoint({'load.1': 2, 'user.jonas': 1})
+
+    load = variable(graph, endpoint, 'load.1')
+    user = variable(graph, endpoint, 'user.jonas')
+    shared = greater(graph, load, graph.add(Constant(1)))
+    first = graph.add(And(None, shared, greater(graph, user, graph.add(Constant(0)))))
+    second = graph.add(And(None, shared, graph.add(Constant(True))))
+    first.evaluate()
+    second.evaluate()
+
+    endpoint.values['load.1'] = 0
+    load.invalidate()
+
+    assert not first.evaluate()
+    assert not second.evaluate()
+    # user.jonas did not change and is still cached
+    assert endpoint.reads == ['load.1', 'user.jonas', 'load.1']
+
+def test_invalidation_does_not_reach_unrelated_nodes():
+    graph = Graph()
+    endpoint = FakeEndpoint({'load.1': 2, 'user.jonas': 1})
+
+    load = greater(graph, variable(graph, endpoint, 'load.1'), graph.add(Constant(1)))
+    user = variable(graph, endpoint, 'user.jonas')
+    user_condition = greater(graph, user, graph.add(Constant(0)))
+    load.evaluate()
+    user_condition.evaluate()
+
+    user.invalidate()
+    load.evaluate()
+
+    assert endpoint.reads == ['load.1', 'user.jonas']
+
+def test_value_computed_while_invalidated_is_not_cached():
+    graph = Graph()
+    endpoint = FakeEndpoint({'load.1': 2})
+    load = variable(graph, endpoint, 'load.1')
+
+    # The state changes while it is read
+    def change():
+        endpoint.values['load.1'] = 0
+        endpoint.on_read = None
+        load.invalidate()
+
+    endpoint.on_read = change
+
+    assert load.evaluate() == 2
+    assert load.evaluate() == 0
+
+def test_missing_value_makes_the_result_missing():
+    graph = Graph()
+    endpoint = FakeEndpoint({'load.1': None})
+
+    assert greater(graph, variable(graph, endpoint, 'load.1'), graph.add(Constant(1))).evaluate() is None
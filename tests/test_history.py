@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+from automato.state.history import History
+
+def test_empty():
+    history = History(3)
+
+    assert len(history) == 0
+    for function in ['avg', 'min', 'max', 'delta', 'rate']:
+        assert getattr(history, function)() is None
+
+def test_wraparound():
+    history = History(3)
+    for i, value in enumerate([1, 2, 3, 4, 5]):
+        history.append(value, i)
+
+    assert len(history) == 3
+    assert history.avg() == 4
+    assert history.min() == 3
+    assert history.max() == 5
+    assert history.delta() == 2
+    assert history.rate() == 1
+
+def test_evicted_extremes():
+    history = History(3)
+    for i, value in enumerate([9, 1, 5, 6, 7]):
+        history.append(value, i)
+
+    # 9 and 1 were evicted
+    assert history.min() == 5
+    assert history.max() == 7
+
+def test_equal_values():
+    history = History(2)
+    for i, value in enumerate([3, 3, 3, 2]):
+        history.append(value, i)
+
+    assert history.min() == 2
+    assert history.max() == 3
+
+def test_size_one():
+    history = History(1)
+    history.append(1, 0)
+    history.append(4, 1)
+
+    assert len(history) == 1
+    assert history.avg() == history.min() == history.max() == 4
+    assert history.delta() == 0
+    assert history.rate() == 0
+
+def test_rate_without_elapsed_time():
+    history = History(3)
+    history.append(1, 5)
+    history.append(2, 5)
+
+    assert history.rate() == 0
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 10])
+def test_matches_window(size):
+    rng = random.Random(size)
+    history = History(size)
+    values = []
+
+    for i in range(5 * size + 3):
+        value = rng.uniform(-100, 100)
+        values.append(value)
+        history.append(value, i * 2)
+
+        window = values[-size:]
+        assert len(history) == len(window)
+        assert history.avg() == pytest.approx(sum(window) / len(window))
+        assert history.min() == min(window)
+        assert history.max() == max(window)
+        assert history.delta() == pytest.approx(window[-1] - window[0])
+        if len(window) > 1:
+            assert history.rate() == pytest.approx((window[-1] - window[0]) / (2 * (len(window) - 1)))
+
+def test_monotonic_queues_stay_bounded():
+    history = History(4)
+    for i in range(1000):
+        history.append(i, i)
+
+    assert len(history._min) <= 4
+    assert len(history._max) <= 4
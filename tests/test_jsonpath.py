@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from automato.state.jsonpath import Selector, compile_path
+
+DOCUMENT = '''{
+  "name": "host \\"1\\"",
+  "skipped": {"a": [1, {"b": "]}"}], "c": null},
+  "status": {"health": "green", "load": [0.5, 1.25e1, -3], "up": true},
+  "items": [{"name": "first"}, {"name": "second", "tags": ["x", "y"]}],
+  "key.with.dots": {"value": 42},
+  "empty": {},
+  "list": []
+}'''
+
+PATHS = {
+    'name': '$.name',
+    'health': 'status.health',
+    'load': 'status.load[1]',
+    'negative': 'status.load[2]',
+    'up': 'status.up',
+    'second': 'items[1].name',
+    'tags': 'items[1].tags',
+    'dots': "['key.with.dots'].value",
+    'empty': 'empty',
+    'list': 'list',
+}
+
+def chunked(text: str, size: int) -> list:
+    return [text[i:i+size] for i in range(0, len(text), size)]
+
+def test_compile_path():
+    assert compile_path('$.status.health') == ('status', 'health')
+    assert compile_path('items[0].name') == ('items', 0, 'name')
+    assert compile_path('''['a.b']["c"]''') == ('a.b', 'c')
+
+    with pytest.raises(ValueError):
+        compile_path('items[')
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, 16, len(DOCUMENT)])
+def test_chunk_splits(size):
+    selector = Selector(PATHS)
+
+    assert selector.select(chunked(DOCUMENT, size)) == selector.selectObject(json.loads(DOCUMENT))
+
+def test_every_split_point():
+    selector = Selector(PATHS)
+    expected = selector.selectObject(json.loads(DOCUMENT))
+
+    for i in range(1, len(DOCUMENT)):
+        assert selector.select([DOCUMENT[:i], DOCUMENT[i:]]) == expected
+
+def test_selected_values():
+    result = Selector(PATHS).select(chunked(DOCUMENT, 4))
+
+    assert result['name'] == 'host "1"'
+    assert result['load'] == 12.5
+    assert result['negative'] == -3
+    assert result['up'] is True
+    assert result['tags'] == ['x', 'y']
+    assert result['dots'] == 42
+    assert result['empty'] == {}
+    assert result['list'] == []
+
+def test_missing_paths_are_left_out():
+    result = Selector({'health': 'status.health', 'missing': 'status.missing', 'index': 'items[5]'}).select([DOCUMENT])
+
+    assert result == {'health': 'green'}
+
+def test_reading_stops_when_everything_was_found():
+    read = []
+
+    def chunks():
+        for chunk in chunked(DOCUMENT, 8):
+            read.append(chunk)
+            yield chunk
+
+    assert Selector({'name': 'name'}).select(chunks()) == {'name': 'host "1"'}
+    assert len(read) < len(chunked(DOCUMENT, 8))
+
+def test_truncated_document():
+    truncated = DOCUMENT[:DOCUMENT.index('"y"')]
+
+    with pytest.raises(ValueError):
+        Selector({'tags': 'items[1].tags'}).select(chunked(truncated, 3))
+
+def test_every_truncation_point():
+    selector = Selector(PATHS)
+    expected = selector.selectObject(json.loads(DOCUMENT))
+
+    for i in range(len(DOCUMENT)):
+        try:
+            result = selector.select(chunked(DOCUMENT[:i], 3))
+        except ValueError:
+            continue
+
+        # Everything was found before the cut
+        assert result == expected
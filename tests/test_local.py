@@ -0,0 +1,89 @@
+import os
+import time
+
+import pytest
+
+from automato.transport.local import LocalTransport
+
+@pytest.fixture
+def tp():
+    tp = LocalTransport({}, timeout=2, shells=2)
+    tp.connect()
+    yield tp
+    tp.disconnect()
+
+def test_exit_codes(tp):
+    assert tp.exec('echo hello') == (b'hello', b'', 0)
+    assert tp.exec('echo error >&2; exit 3') == (b'', b'error', 3)
+    assert tp.exec('false')[2] == 1
+
+def test_shell_is_reused_after_exit(tp):
+    tp.exec('exit 5')
+    tp.exec('true')
+
+    assert len(tp._idle) == 1
+    assert tp.exec('echo still running') == (b'still running', b'', 0)
+
+def test_commands_do_not_share_state(tp):
+    tp.exec('cd /; export AUTOMATO_TEST=1')
+
+    assert tp.exec('echo "x$AUTOMATO_TEST"; pwd')[0] == f'x\n{os.getcwd()}'.encode()
+
+def test_commands_do_not_read_stdin(tp):
+    assert tp.exec('cat; echo done')[0] == b'done'
+
+def test_output_without_trailing_newline(tp):
+    assert tp.exec('printf "a\\n\\nb"')[0] == b'a\n\nb'
+
+def test_delimiter_like_output(tp):
+    out, err, retcode = tp.exec('echo "automato-0123 7"; echo "automato-0123" >&2')
+
+    assert (out, err, retcode) == (b'automato-0123 7', b'automato-0123', 0)
+
+def test_empty_lines_are_kept(tp):
+    assert list(tp.execStream('printf "a\\n\\n\\nb\\n"')) == [b'a', b'', b'', b'b']
+    assert list(tp.execStream('printf "a\\n\\n"')) == [b'a', b'']
+
+def test_stream_raises_on_error(tp):
+    lines = []
+    with pytest.raises(Exception, match='error 2'):
+        for line in tp.execStream('echo partial; exit 2'):
+            lines.append(line)
+
+    assert lines == [b'partial']
+
+def test_timeout_kills_the_shell(tp):
+    start = time.monotonic()
+    with pytest.raises(Exception, match='timed out'):
+        list(tp.execStream('sleep 10', timeout=0.2))
+
+    assert time.monotonic() - start < 2
+    assert tp._idle == []
+    assert tp.exec('echo next') == (b'next', b'', 0)
+
+def test_max_bytes(tp):
+    with pytest.raises(Exception, match='more than 100 bytes'):
+        list(tp.execStream('head -c 1000 /dev/zero | tr "\\0" "x"', max_bytes=100))
+
+def test_files_are_read_directly(tp, tmp_path):
+    path = tmp_path / 'loadavg'
+    path.write_bytes(b'0.5 0.4 0.3 1/2 3\n')
+
+    assert tp.exec(f'cat {path}') == (b'0.5 0.4 0.3 1/2 3', b'', 0)
+    assert list(tp.execStream(f'cat "{path}"')) == [b'0.5 0.4 0.3 1/2 3']
+    assert tp.exec(f'cat {tmp_path}/missing') == (b'', f'cat: {tmp_path}/missing: No such file or directory'.encode(), 1)
+    assert tp._idle == []
+
+def test_execHandleStderror(tp):
+    assert tp.execHandleStderror('echo ok') == b'ok'
+
+    with pytest.raises(Exception, match='error 4'):
+        tp.execHandleStderror('exit 4')
+
+def test_disconnect_stops_idle_shells(tp):
+    tp.exec('true')
+    shell = tp._idle[0]
+
+    tp.disconnect()
+
+    assert not shell.alive()
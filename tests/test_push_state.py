@@ -0,0 +1,56 @@
+from automato.state.push import PushState
+
+class FakePushTransport:
+    def __init__(self):
+        self.callbacks = {}
+
+    def subscribe(self, state: str, callback):
+        self.callbacks[state] = callback
+
+    def push(self, state: str, data: dict):
+        self.callbacks[state](data)
+
+def push_state(tp: FakePushTransport, **kwargs) -> PushState:
+    stt = PushState({}, transport=tp, **kwargs)
+    stt.setName('h', 'mem')
+    return stt
+
+def test_missing_before_first_push():
+    stt = push_state(FakePushTransport(), source='automato.state.LinuxMemoryState')
+
+    assert stt.get('MemFree') is None
+
+def test_changes_are_reported_like_the_source():
+    tp = FakePushTransport()
+    stt = push_state(tp, source='automato.state.LinuxMemoryState')
+    changes = []
+    stt.addListener(changes.append)
+
+    tp.push('mem', {'MemTotal': 1000, 'MemFree': 500})
+    tp.push('mem', {'MemTotal': 1000, 'MemFree': 50})
+    tp.push('mem', {'MemTotal': 1000, 'MemFree': 50})
+
+    assert changes == [None, {'MemFree', 'mem'}]
+    assert stt.get('MemFree') == 50
+    assert stt.get('mem.MemFree') == 50
+    assert stt.get('mem') == {'MemTotal': 1000, 'MemFree': 50}
+
+def test_changes_without_source():
+    tp = FakePushTransport()
+    stt = push_state(tp)
+    changes = []
+    stt.addListener(changes.append)
+
+    tp.push('mem', {'a': 1, 'b': 2})
+    tp.push('mem', {'a': 1, 'b': 3})
+
+    assert changes == [None, {'b'}]
+    assert stt.get('b') == 3
+
+def test_source_defaults():
+    tp = FakePushTransport()
+    stt = push_state(tp, source='automato.state.UserSessionState')
+    tp.push('mem', {'bob': 2})
+
+    assert stt.get('bob') == 2
+    assert stt.get('alice') == 0
@@ -0,0 +1,43 @@
+import time
+
+from automato.scheduler import Scheduler
+
+class FakeAction:
+    def __init__(self, next_run):
+        self.next_run = next_run
+        self.runs = 0
+
+    def execute(self):
+        self.runs += 1
+
+    def nextRun(self):
+        return self.next_run
+
+def test_due_triggers_wait_for_min_looptime():
+    act = FakeAction(0)
+    sched = Scheduler({'a': act}, workers=1, min_looptime=5)
+
+    next_run = sched.run()
+    sched.run()
+    sched.shutdown()
+
+    assert act.runs == 1
+    assert next_run >= time.time() + 4
+
+def test_without_min_looptime_due_actions_run_every_time():
+    act = FakeAction(0)
+    sched = Scheduler({'a': act}, workers=1, min_looptime=0)
+
+    for _ in range(3):
+        sched.run()
+    sched.shutdown()
+
+    assert act.runs == 3
+
+def test_looptime_without_next_run():
+    sched = Scheduler({'a': FakeAction(None)}, workers=1, looptime=30)
+
+    next_run = sched.run()
+    sched.shutdown()
+
+    assert time.time() + 29 <= next_run <= time.time() + 30